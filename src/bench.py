@@ -0,0 +1,170 @@
+"""
+録画した懸垂のセッションを使ったベンチマーク
+
+pygameを使わずに capture → face → pose → counting を動画に対して実行し、
+段階ごとの処理時間、フレームレート、最大メモリ使用量、回数の正確さをJSONで出力する
+
+マニフェストは次の形式のJSON：
+[
+    {"video": "sessions/a.mp4", "count": 12, "bar": [0.7, 0.3]},
+    ...
+]
+barを省略した場合は動画の先頭からマーカーを探す
+"""
+
+import argparse
+import json
+import logging
+import resource
+import time
+
+import cv2
+import numpy as np
+
+import capture
+import counter
+import face
+import marker
+import metrics
+import pose
+
+logger = logging.getLogger(__name__)
+
+
+def run_session(
+    video: str,
+    bar: tuple[float, float] | None,
+    recognize: bool,
+    rep_detector: str = "threshold",
+) -> dict:
+    """
+    1本の動画をゲームと同じ順序で処理し、数えた回数などを返す
+    """
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open video: {video}")
+    # 前の動画の顔や姿勢の追跡を引き継がないように、動画ごとに初めからやり直す
+    face.reset_tracking()
+    pose.reset_tracking()
+
+    calibrator = marker.Calibrator()
+    voter = face.IdentityVoter()
+    name = None
+    rep_counter = None
+    frames = 0
+    while True:
+        with metrics.span("capture"):
+            ret, frame = cap.read()
+        if not ret:
+            break
+        frames += 1
+        timestamp_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+        frame = capture.FrameContext(frame, timestamp_ms / 1000, frames)
+
+        # marker, face, poseの段階は各モジュールが測る
+        if bar is None:
+            bar = calibrator.update(frame)
+            continue
+
+        if recognize and name is None:
+            name = voter.add(face.recognize_faces(frame))
+            continue
+
+        result = pose.detect_pose(frame, bar)
+        with metrics.span("count"):
+            if rep_counter is None:
+                if counter.hands_on_bar(result, bar):
+                    rep_counter = counter.create(rep_detector, bar)
+            else:
+                rep_counter.update(result, timestamp_ms)
+        if rep_counter is not None and rep_counter.finished:
+            break
+    cap.release()
+
+    return {
+        "video": video,
+        "frames": frames,
+        "name": name,
+        "bar": bar,
+        "counted": rep_counter.count if rep_counter else 0,
+    }
+
+
+def summarize(sessions: list[dict], elapsed: float) -> dict:
+    errors = [abs(s["counted"] - s["expected"]) for s in sessions]
+    frames = sum(s["frames"] for s in sessions)
+    return {
+        "stages": metrics.snapshot(),
+        "frames": frames,
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else None,
+        # Linuxではキロバイト単位
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "accuracy": {
+            "exact": sum(e == 0 for e in errors) / len(errors) if errors else None,
+            "mean_abs_error": float(np.mean(errors)) if errors else None,
+        },
+        "sessions": sessions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kensuiou replay benchmark")
+    parser.add_argument("manifest", type=str)
+    parser.add_argument("--face-feature", type=str, default=None)
+    parser.add_argument(
+        "--pose-model-complexity", choices=[0, 1, 2], type=int, default=0
+    )
+    parser.add_argument("--pose-mode", choices=pose.MODES, type=str, default="static")
+    parser.add_argument(
+        "--marker", choices=marker.MARKER_TYPES, type=str, default="chessboard"
+    )
+    parser.add_argument(
+        "--rep-detector",
+        choices=counter.DETECTORS,
+        type=str,
+        default="threshold",
+        help="landmarks are smoothed only with peak; threshold uses raw landmarks",
+    )
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # 分位点は直近の分だけでなく、全部の動画の全フレームから求める
+    metrics.enable(window=None)
+
+    with open(args.manifest, "r") as f:
+        manifest = json.load(f)
+
+    # 顔特徴量を指定しなければ顔認証は飛ばす
+    if args.face_feature:
+        face.init(args.face_feature)
+    pose.init(args.pose_model_complexity, args.pose_mode)
+    marker.init(args.marker)
+
+    sessions = []
+    start = time.perf_counter()
+    for entry in manifest:
+        bar = tuple(entry["bar"]) if entry.get("bar") else None
+        session = run_session(
+            entry["video"], bar, args.face_feature is not None, args.rep_detector
+        )
+        session["expected"] = entry["count"]
+        logger.info(
+            f"{entry['video']}: counted {session['counted']}"
+            f" (expected {entry['count']})"
+        )
+        sessions.append(session)
+    report = summarize(sessions, time.perf_counter() - start)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
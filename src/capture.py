@@ -1,46 +1,356 @@
+import logging
+import threading
+import time
+import weakref
+
 import cv2
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 待機中のカメラの扱い
+# keep: 開いたまま / lowres: 低解像度で開いたまま / release: 一定時間後に解放
+IDLE_POLICIES = ("keep", "lowres", "release")
+IDLE_SIZE = (320, 240)
+# 露出が落ち着いたとみなす最低の平均輝度
+READY_MIN_BRIGHTNESS = 20
+# 撮影画像と派生画像のバッファを大きさごとに取っておく数
+BUFFER_POOL_SIZE = 8
 
 cap = cv2.VideoCapture()
 _width = None
 _height = None
+_threaded = False
+_idle_policy = "release"
+_idle_release_seconds = 0.0
 
+_cap_lock = threading.RLock()
+# releaseポリシーでカメラを解放する時刻(time.monotonic())。standby()で決まる
+_release_deadline: float | None = None
+_ready = threading.Event()
+_expected_shape: tuple[int, int] | None = None
+# lowresポリシーで待機中か。standby()で立ち、activate()とrelease()で下りる
+_lowres = False
 
-def init(width: int, height: int) -> None:
-    global _width, _height
+_lock = threading.Lock()
+_latest: "FrameContext | None" = None
+_seq = 0
+_grabber: threading.Thread | None = None
+_stop = threading.Event()
+
+_pool_lock = threading.Lock()
+_pool: dict[tuple[int, ...], list[np.ndarray]] = {}
+
+
+def _take_buffer(shape: tuple[int, ...]) -> np.ndarray:
+    with _pool_lock:
+        buffers = _pool.get(shape)
+        if buffers:
+            return buffers.pop()
+    return np.empty(shape, dtype=np.uint8)
+
+
+def _recycle(buffers: list[np.ndarray]) -> None:
+    with _pool_lock:
+        for buffer in buffers:
+            free = _pool.setdefault(buffer.shape, [])
+            if len(free) < BUFFER_POOL_SIZE:
+                free.append(buffer)
+    buffers.clear()
+
+
+class FrameContext:
+    """
+    撮影した1フレーム(BGR)と、そこから作るRGB・グレースケール・縮小画像
+
+    派生画像は最初に求められたときに1回だけ作り、このフレームを使う検出器の間で共有する
+    作った画像のバッファはフレームが使われなくなると次のフレームで使い回すので、
+    派生画像をフレームより長く持つ場合はコピーすること
+    threadedで撮影した元の画像も同じで、グラバーが次の撮影に使い回す
+    """
+
+    def __init__(self, image: cv2.Mat, timestamp: float, seq: int):
+        self.image = image
+        self.timestamp = timestamp
+        self.seq = seq
+        self._derived: dict[tuple, np.ndarray] = {}
+        self._buffers: list[np.ndarray] = []
+        # 別々のスレッドの検出器から同時に求められても変換は1回にする
+        self._lock = threading.RLock()
+        weakref.finalize(self, _recycle, self._buffers)
+
+    def __getstate__(self) -> dict:
+        # processで推論するときは元の画像だけを送り、派生画像は子プロセスで作る
+        return {"image": self.image, "timestamp": self.timestamp, "seq": self.seq}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
+
+    def rgb(self) -> np.ndarray:
+        return self._derive(
+            ("rgb",),
+            self.image.shape,
+            lambda dst: cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB, dst=dst),
+        )
+
+    def gray(self) -> np.ndarray:
+        return self._derive(
+            ("gray",),
+            self.image.shape[:2],
+            lambda dst: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY, dst=dst),
+        )
+
+    def resized(self, scale: float, gray: bool = False) -> np.ndarray:
+        """
+        RGBかグレースケールの画像をscale倍に縮小した画像
+        大きさはcv2.resizeにfx, fyを渡した場合と同じ
+        """
+        source = self.gray() if gray else self.rgb()
+        height, width = source.shape[:2]
+        size = (round(width * scale), round(height * scale))
+        return self._derive(
+            ("gray" if gray else "rgb", scale),
+            (size[1], size[0]) + source.shape[2:],
+            lambda dst: cv2.resize(source, size, dst=dst),
+        )
+
+    def _derive(self, key: tuple, shape: tuple[int, ...], make) -> np.ndarray:
+        with self._lock:
+            derived = self._derived.get(key)
+            if derived is None:
+                buffer = _take_buffer(shape)
+                derived = make(buffer)
+                if derived is buffer:
+                    self._buffers.append(buffer)
+                self._derived[key] = derived
+            return derived
+
+
+def init(
+    width: int,
+    height: int,
+    threaded: bool = False,
+    idle_policy: str = "release",
+    idle_release_minutes: float = 0.0,
+) -> None:
+    """
+    threadedがTrueの場合、専用スレッドでカメラを読み続け、
+    read系の関数は最新のフレームをブロックせずに返す
+    """
+    global _width, _height, _threaded, _idle_policy, _idle_release_seconds
+    if idle_policy not in IDLE_POLICIES:
+        raise ValueError(f"Unknown idle policy: {idle_policy}")
     _width = width
     _height = height
+    _threaded = threaded
+    _idle_policy = idle_policy
+    _idle_release_seconds = idle_release_minutes * 60
 
 
 def open():
     global cap
-    if cap.isOpened():
-        return
-    cap.open(0)
+    with _cap_lock:
+        if cap.isOpened():
+            return
+        cap.open(0)
+        if not cap.isOpened():
+            raise RuntimeError("Could not open video capture")
+        _set_resolution(_width, _height)
+    if _threaded:
+        _start_grabber()
+
+
+def _set_resolution(width: int, height: int) -> None:
+    global _expected_shape
+    with _cap_lock:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        # カメラが実際に採用した解像度を基準にする
+        _expected_shape = (
+            int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        )
+    _ready.clear()
+
+
+def set_resolution(width: int, height: int) -> None:
+    """
+    セッション中の解像度を変える。以後activate()で戻る解像度もこれになる
+    """
+    global _width, _height
+    _width = width
+    _height = height
+    if cap.isOpened() and not _lowres:
+        _set_resolution(width, height)
+
+
+def activate() -> None:
+    """
+    セッション開始時に呼ぶ
+    待機ポリシーで解放・低解像度化されていれば元に戻す
+    """
+    global _release_deadline, _lowres
+    _release_deadline = None
     if not cap.isOpened():
-        raise RuntimeError("Could not open video capture")
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, _width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, _height)
+        _lowres = False
+        open()
+    elif _lowres:
+        _lowres = False
+        _set_resolution(_width, _height)
 
 
-def read() -> cv2.Mat:
-    global cap
+def standby() -> None:
+    """
+    セッション終了時に呼ぶ
+    releaseの代わりに待機ポリシーに従ってカメラを休ませる
+    """
+    global _release_deadline, _lowres
+    if not cap.isOpened():
+        return
+    if _idle_policy == "lowres":
+        _set_resolution(*IDLE_SIZE)
+        _lowres = True
+    elif _idle_policy == "release":
+        if _idle_release_seconds <= 0:
+            release()
+            return
+        if _release_deadline is None:
+            _release_deadline = time.monotonic() + _idle_release_seconds
+
+
+def release_if_idle() -> None:
+    """
+    待機中にゲームループから呼び、standby()から待機時間が過ぎていればカメラを解放する
+    読み込みと同じスレッドで解放するので、開いているか確かめてから読むまでの間に閉じられない
+    """
+    if _release_deadline is not None and time.monotonic() >= _release_deadline:
+        logger.info("Releasing idle video capture")
+        release()
+
+
+def is_ready() -> bool:
+    """
+    現在の解像度で露出の落ち着いたフレームが一度でも得られたか
+    """
+    return _ready.is_set()
+
+
+def _check_ready(image: np.ndarray) -> None:
+    if _ready.is_set() or image.shape[:2] != _expected_shape:
+        return
+    # 全画素の平均は重いので間引いて見る
+    if image[::16, ::16].mean() >= READY_MIN_BRIGHTNESS:
+        _ready.set()
+
+
+def _start_grabber() -> None:
+    global _grabber, _latest
+    _latest = None
+    _stop.clear()
+    _grabber = threading.Thread(target=_grab_loop, name="capture-grabber", daemon=True)
+    _grabber.start()
+
+
+def _stop_grabber() -> None:
+    global _grabber, _latest
+    if _grabber is None:
+        return
+    _stop.set()
+    _grabber.join()
+    _grabber = None
+    _latest = None
+
+
+def _grab_loop() -> None:
+    """
+    プールから借りたバッファに次々と書き込み、最新のフレームとして差し替える
+    バッファはフレームがどこからも参照されなくなってから返されるので、
+    検出器や推論ワーカーが持っている間のフレームが上書きされることはない
+    """
+    global _latest, _seq
+    while not _stop.is_set():
+        buffer = _take_buffer(_expected_shape + (3,))
+        with _cap_lock:
+            if not cap.grab():
+                ret = False
+            else:
+                # 解像度が想定と異なる場合はretrieveが新しい配列を返す
+                ret, image = cap.retrieve(buffer)
+        if not ret:
+            _recycle([buffer])
+            logger.warning("Failed to grab frame from video capture")
+            time.sleep(0.01)
+            continue
+        if image is not buffer:
+            _recycle([buffer])
+        _check_ready(image)
+        with _lock:
+            _seq += 1
+            frame = FrameContext(image=image, timestamp=time.monotonic(), seq=_seq)
+            frame._buffers.append(image)
+            _latest = frame
+
+
+@metrics.timed("capture")
+def read_frame() -> FrameContext | None:
+    """
+    最新のフレームを撮影時刻・通し番号とともに返す
+    threadedの場合、次のフレームが撮れるまでは同じFrameContextを返す
+    """
+    global cap, _seq
     if not cap.isOpened():
         raise RuntimeError("Video capture is not opened")
 
-    ret, frame = cap.read()
+    if _threaded:
+        with _lock:
+            return _latest
+
+    with _cap_lock:
+        ret, image = cap.read()
     if not ret:
         return None
-    return frame
+    _check_ready(image)
+    _seq += 1
+    return FrameContext(image=image, timestamp=time.monotonic(), seq=_seq)
+
+
+def is_opened() -> bool:
+    return cap.isOpened()
+
+
+def last_seq() -> int:
+    """
+    これまでに読み込んだ最新フレームの通し番号
+    """
+    return _seq
+
+
+def read() -> cv2.Mat:
+    frame = read_frame()
+    if frame is None:
+        return None
+    if _threaded:
+        # フレームより長く使われるので、グラバーが使い回すバッファは返さない
+        return frame.image.copy()
+    return frame.image
 
 
 def read_rgb() -> cv2.Mat:
-    frame = read()
+    frame = read_frame()
     if frame is None:
         return None
-    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    # フレームより長く使われるので共有のバッファは返さない
+    return cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB)
 
 
 def release() -> None:
-    global cap
-    if cap.isOpened():
-        cap.release()
+    global cap, _release_deadline, _lowres
+    _release_deadline = None
+    _stop_grabber()
+    with _cap_lock:
+        if cap.isOpened():
+            cap.release()
+    _lowres = False
+    _ready.clear()
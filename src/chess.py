@@ -2,26 +2,54 @@ import logging
 
 import cv2
 
+import capture
+
 logger = logging.getLogger(__name__)
 
 PATTERN_SIZE = (3, 3)
 
+# コーナーの検出は縮小した画像で行い、元の解像度でサブピクセル精度に詰める
+DETECT_SCALE = 0.5
+DETECT_FLAGS = (
+    cv2.CALIB_CB_ADAPTIVE_THRESH
+    | cv2.CALIB_CB_NORMALIZE_IMAGE
+    | cv2.CALIB_CB_FAST_CHECK
+)
+SUBPIX_WINDOW = (5, 5)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+
+def find_chessboard_center(gray: cv2.Mat) -> tuple[float, float] | None:
+    """
+    グレースケール画像に含まれるチェスボードの中心座標をピクセルで返す
+    """
+    small = cv2.resize(gray, (0, 0), fx=DETECT_SCALE, fy=DETECT_SCALE)
+    return _find(gray, small)
+
 
-def detect_chessboard_center(frame: cv2.Mat) -> tuple[float, float] | None:
+def detect_chessboard_center(
+    frame: capture.FrameContext,
+) -> tuple[float, float] | None:
     """
-    frameに含まれるチェスボードの中心座標を割合で返す
+    フレーム全体からチェスボードを探す。縮小画像は他の検出器と共有する
     """
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    ret, corners = cv2.findChessboardCorners(gray, PATTERN_SIZE, None)
+    return _find(frame.gray(), frame.resized(DETECT_SCALE, gray=True))
+
+
+def _find(gray: cv2.Mat, small: cv2.Mat) -> tuple[float, float] | None:
+    ret, corners = cv2.findChessboardCorners(small, PATTERN_SIZE, DETECT_FLAGS)
 
     if not ret:
         logger.debug("failed to detect chessboard corners")
         return None
 
+    # 見つかったコーナーの周辺だけを元の解像度で詰める
+    corners = corners / DETECT_SCALE
+    cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW, (-1, -1), SUBPIX_CRITERIA)
+
     # チェスボードの中心を計算
-    center = corners.mean(axis=0)[0]
-    height, width, _ = frame.shape
-    return (center[0] / width, center[1] / height)
+    center = corners.reshape(-1, 2).mean(axis=0)
+    return (float(center[0]), float(center[1]))
 
 
 if __name__ == "__main__":
@@ -29,12 +57,17 @@ if __name__ == "__main__":
     import sys
     import time
 
+    import marker
+
     logging.basicConfig(level=logging.DEBUG)
+    marker.init("chessboard")
 
     cap = cv2.VideoCapture(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
     if not cap.isOpened():
         logger.error("Could not open video capture")
         exit(1)
+    seq = 0
+    center = None
     while True:
         ret, frame = cap.read()
         if not ret:
@@ -42,8 +75,11 @@ if __name__ == "__main__":
             exit(1)
         frame = cv2.resize(frame, (640, 480))
         cv2.imwrite("test_frame.jpg", frame)
+        seq += 1
         start_time = time.time()
-        center = detect_chessboard_center(frame)
+        center = marker.detect_marker_center(
+            capture.FrameContext(frame, time.monotonic(), seq), center
+        )
         elapsed_time = time.time() - start_time
         logger.info(f"Chessboard detection took {elapsed_time:.2f} seconds")
 
@@ -0,0 +1,299 @@
+"""
+懸垂の回数を数える
+
+pygameに依存しないので、ゲームでも録画を使ったベンチマークでも同じ判定を使える
+1フレームずつ与えるRepCounterと、記録全体をNumPyでまとめて処理するcount_repsがあり、
+どちらも同じ回数を返す
+"""
+
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+import numpy as np
+
+import filters
+
+if TYPE_CHECKING:
+    from pose import PoseDetectionResult
+
+
+def hands_on_bar(result: "PoseDetectionResult", bar: tuple[float, float]) -> bool:
+    """
+    両手がバーの高さまで上がっているか
+    """
+    return bool(
+        result
+        and result.left_hand
+        and result.right_hand
+        and result.left_hand[1] <= bar[1]
+        and result.right_hand[1] <= bar[1]
+    )
+
+
+def is_wide(result: "PoseDetectionResult", bar: tuple[float, float]) -> bool:
+    """
+    左手がバーの中心より外側を握っていればワイド
+    """
+    return result.left_hand[0] > bar[0]
+
+
+DETECTORS = ("threshold", "peak")
+# 顔がバーからこれ以上(画像の高さに対する割合)下がるまで次の1回を数えない
+CHINUP_RESET_THRESHOLD = 0.2
+# 手がバーから離れたままこの時間が経ったら終わる
+COUNTING_TIMEOUT_MS = 2000
+# 放物線の頂点として、真ん中のサンプルからこれ以上離れた高さは信用しない
+PEAK_MAX_EXTRAPOLATION = 0.1
+
+
+@dataclass
+class RepEvent:
+    count: int
+    timestamp_ms: float
+
+
+class RepCounter:
+    """
+    顔がバーを越えたら1回数え、顔がバーからreset_threshold以上下がるまでは数えない
+    手が下がったままか、結果が届かないままtimeout_ms経つとfinishedになる
+    """
+
+    def __init__(
+        self,
+        bar: tuple[float, float],
+        reset_threshold: float = CHINUP_RESET_THRESHOLD,
+        timeout_ms: float = COUNTING_TIMEOUT_MS,
+    ):
+        self.bar = bar
+        self.reset_threshold = reset_threshold
+        self.timeout_ms = timeout_ms
+        self.count = 0
+        self.chinuped = False
+        self.finished = False
+        self._last_valid_ms: float | None = None
+
+    def update(
+        self, result: "PoseDetectionResult", timestamp_ms: float
+    ) -> RepEvent | None:
+        """
+        結果を1つ加え、回数が増えたらそのイベントを返す
+        """
+        if not self._accept(result, timestamp_ms):
+            return None
+
+        reset_y = self.bar[1] + self.reset_threshold
+        event = None
+        # 顔がバーを越えたらカウント
+        if result.nose[1] <= self.bar[1] and not self.chinuped:
+            self.chinuped = True
+            self.count += 1
+            event = RepEvent(count=self.count, timestamp_ms=timestamp_ms)
+        # 顔が一定以上下がったらリセット
+        if result.nose[1] > reset_y:
+            self.chinuped = False
+        return event
+
+    def _accept(self, result: "PoseDetectionResult", timestamp_ms: float) -> bool:
+        """
+        手がバーにある結果ならTrue
+        そうでない状態がtimeout_ms続いたらfinishedにする
+        """
+        if self._last_valid_ms is None:
+            self._last_valid_ms = timestamp_ms
+        reset_y = self.bar[1] + self.reset_threshold
+
+        if (
+            not (result and result.nose and result.left_hand and result.right_hand)
+            or result.left_hand[1] > reset_y
+            or result.right_hand[1] > reset_y
+        ):
+            if timestamp_ms - self._last_valid_ms >= self.timeout_ms:
+                self.finished = True
+            return False
+
+        self._last_valid_ms = timestamp_ms
+        return True
+
+    def expire(self, timestamp_ms: float) -> bool:
+        """
+        結果が届かないときに現在の時刻で呼び、最後に手がバーにあってからtimeout_ms経っていればfinishedにする
+        timestamp_msは結果の時刻と同じ時計で測る
+        """
+        if self._last_valid_ms is None:
+            self._last_valid_ms = timestamp_ms
+        if timestamp_ms - self._last_valid_ms >= self.timeout_ms:
+            self.finished = True
+        return self.finished
+
+    def feed(
+        self, stream: Iterable[tuple["PoseDetectionResult", float]]
+    ) -> Iterator[RepEvent]:
+        """
+        (結果, 時刻)の列を順に与え、終わるまでのイベントを返す
+        """
+        for result, timestamp_ms in stream:
+            event = self.update(result, timestamp_ms)
+            if event is not None:
+                yield event
+            if self.finished:
+                return
+
+
+class PeakRepCounter(RepCounter):
+    """
+    平滑化した鼻の高さの山と谷で数える
+
+    鼻の高さが極値をとったら前後3サンプルに当てはめた放物線の頂点で判定するので、
+    サンプルの間でバーを越えていてもフレームレートによらず数えられる
+    判定の条件(越えたら数え、十分下がるまで数えない)はRepCounterと同じ
+    """
+
+    def __init__(
+        self,
+        bar: tuple[float, float],
+        reset_threshold: float = CHINUP_RESET_THRESHOLD,
+        timeout_ms: float = COUNTING_TIMEOUT_MS,
+    ):
+        super().__init__(bar, reset_threshold, timeout_ms)
+        self.smoother = filters.LandmarkSmoother()
+        self._samples: deque[tuple[float, float]] = deque(maxlen=3)
+
+    def update(
+        self, result: "PoseDetectionResult", timestamp_ms: float
+    ) -> RepEvent | None:
+        result = self.smoother(result, timestamp_ms)
+        if not self._accept(result, timestamp_ms):
+            # 手を離している間をまたいで極値を探さない
+            self._samples.clear()
+            return None
+
+        self._samples.append((timestamp_ms, result.nose[1]))
+        event = None
+        # 1つ前のサンプルが極値なら、先にその頂点で判定する
+        vertex = self._vertex()
+        if vertex is not None:
+            event = self._step(*vertex)
+        return self._step(timestamp_ms, result.nose[1]) or event
+
+    def _vertex(self) -> tuple[float, float] | None:
+        if len(self._samples) < 3:
+            return None
+        (t0, y0), (t1, y1), (t2, y2) = self._samples
+        is_top = y1 <= y0 and y1 < y2
+        is_bottom = y1 >= y0 and y1 > y2
+        if not (is_top or is_bottom) or t2 <= t0:
+            return None
+        a, b, c = np.polyfit([t0 - t1, 0.0, t2 - t1], [y0, y1, y2], 2)
+        if a == 0:
+            return None
+        t = float(np.clip(-b / (2 * a), t0 - t1, t2 - t1))
+        y = float(a * t * t + b * t + c)
+        y = float(np.clip(y, y1 - PEAK_MAX_EXTRAPOLATION, y1 + PEAK_MAX_EXTRAPOLATION))
+        return (t1 + t, y)
+
+    def _step(self, timestamp_ms: float, nose_y: float) -> RepEvent | None:
+        event = None
+        if nose_y <= self.bar[1] and not self.chinuped:
+            self.chinuped = True
+            self.count += 1
+            event = RepEvent(count=self.count, timestamp_ms=timestamp_ms)
+        if nose_y > self.bar[1] + self.reset_threshold:
+            self.chinuped = False
+        return event
+
+
+def create(
+    detector: str,
+    bar: tuple[float, float],
+    reset_threshold: float = CHINUP_RESET_THRESHOLD,
+    timeout_ms: float = COUNTING_TIMEOUT_MS,
+) -> RepCounter:
+    """
+    DETECTORSのうちdetectorの判定を使うカウンターを作る
+    """
+    if detector == "threshold":
+        return RepCounter(bar, reset_threshold, timeout_ms)
+    if detector == "peak":
+        return PeakRepCounter(bar, reset_threshold, timeout_ms)
+    raise ValueError(f"Unknown rep detector: {detector}")
+
+
+# to_arrayで並べるランドマークの順
+NOSE, LEFT_HAND, RIGHT_HAND = range(3)
+
+
+def to_array(results: Iterable["PoseDetectionResult"]) -> np.ndarray:
+    """
+    結果の列を(フレーム数, 3, 2)の配列にする。見つからなかった点はNaN
+    """
+    rows = [
+        [
+            point if point is not None else (np.nan, np.nan)
+            for point in (result.nose, result.left_hand, result.right_hand)
+        ]
+        if result is not None
+        else [(np.nan, np.nan)] * 3
+        for result in results
+    ]
+    return np.asarray(rows, dtype=np.float64).reshape(-1, 3, 2)
+
+
+def count_reps(
+    landmarks: np.ndarray,
+    timestamps_ms: np.ndarray,
+    bar: tuple[float, float],
+    reset_threshold: float = CHINUP_RESET_THRESHOLD,
+    timeout_ms: float = COUNTING_TIMEOUT_MS,
+) -> np.ndarray:
+    """
+    RepCounterと同じ判定を記録全体に対してまとめて行い、数えた時刻の配列を返す
+    landmarksはto_arrayの形式
+    """
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.float64)
+    if len(timestamps_ms) == 0:
+        return timestamps_ms
+    nose_y = landmarks[:, NOSE, 1]
+    reset_y = bar[1] + reset_threshold
+    with np.errstate(invalid="ignore"):
+        valid = (
+            np.isfinite(landmarks).all(axis=(1, 2))
+            & (landmarks[:, LEFT_HAND, 1] <= reset_y)
+            & (landmarks[:, RIGHT_HAND, 1] <= reset_y)
+        )
+
+    # 最後に手がバーにあった時刻からtimeout_ms経ったフレームで終わる
+    last_valid = np.maximum.accumulate(np.where(valid, timestamps_ms, -np.inf), axis=0)
+    last_valid = np.maximum(last_valid, timestamps_ms[0])
+    timed_out = np.flatnonzero(~valid & (timestamps_ms - last_valid >= timeout_ms))
+    end = timed_out[0] if len(timed_out) else len(timestamps_ms)
+    valid = valid[:end]
+    nose_y = nose_y[:end]
+
+    # 状態が変わりうるのは顔がバーを越えたフレームと、十分下がったフレームだけ
+    with np.errstate(invalid="ignore"):
+        up = valid & (nose_y <= bar[1])
+        down = valid & (nose_y > reset_y)
+    changes = np.flatnonzero(up | down)
+    is_up = up[changes]
+    # 直前の変化が「下がった」か、最初の変化が「越えた」ときに1回数える
+    counted = is_up & np.concatenate([[True], ~is_up[:-1]])
+    return timestamps_ms[changes[counted]]
+
+
+def count_reps_batch(
+    sessions: Iterable[tuple[np.ndarray, np.ndarray, tuple[float, float]]],
+    reset_threshold: float = CHINUP_RESET_THRESHOLD,
+    timeout_ms: float = COUNTING_TIMEOUT_MS,
+) -> np.ndarray:
+    """
+    (landmarks, timestamps_ms, bar)の列を受け取り、セッションごとの回数を返す
+    閾値を変えて過去の記録を数え直すときに使う
+    """
+    return np.asarray(
+        [
+            len(count_reps(landmarks, timestamps, bar, reset_threshold, timeout_ms))
+            for landmarks, timestamps, bar in sessions
+        ],
+        dtype=np.int64,
+    )
@@ -1,7 +1,20 @@
+import logging
 import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
 import psycopg
 from dotenv import load_dotenv
+from psycopg.conninfo import make_conninfo
+
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # .envファイルをロード
 load_dotenv()
@@ -11,43 +24,449 @@ PASSWORD = os.getenv("POSTGRES_PASSWORD")
 DBNAME = os.getenv("POSTGRES_DATABASE")
 PORT = os.getenv("POSTGRES_PORT")
 
-# データベースとのコネクションを確立
-connection = psycopg.connect(
-    f"host={HOST} user={USER} password={PASSWORD} dbname={DBNAME} port={PORT}"
+POOL_SIZE = 2
+CONNECT_TIMEOUT_SECONDS = 5
+STATEMENT_TIMEOUT_MS = 5000
+# これ以上使われていなかったコネクションは貸し出す前に生きているか確かめる
+HEALTH_CHECK_IDLE_SECONDS = 30
+RECONNECT_MIN_SECONDS = 1.0
+RECONNECT_MAX_SECONDS = 60.0
+
+CONNINFO = make_conninfo(
+    host=HOST,
+    user=USER,
+    password=PASSWORD,
+    dbname=DBNAME,
+    port=PORT,
+    connect_timeout=CONNECT_TIMEOUT_SECONDS,
+    options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
 )
 
 
-def register_record(name, count, wide):
-    cursor = connection.cursor()
-    # student_idsを利用してidをmembersテーブルから取得
-    cursor.execute(
+class _Pool:
+    """
+    必要になったときに接続する小さなコネクションプール
+
+    切れたコネクションは捨てて接続し直し、接続に失敗した後は
+    間隔を空けるまで接続を試みずにすぐエラーにする
+    """
+
+    def __init__(self, size: int):
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._next_attempt = 0.0
+        self._delay = RECONNECT_MIN_SECONDS
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=CONNECT_TIMEOUT_SECONDS):
+            raise psycopg.OperationalError("Timed out waiting for a pooled connection")
+        try:
+            connection = self._get()
+            try:
+                yield connection
+            except BaseException:
+                if not connection.closed and not connection.broken:
+                    connection.rollback()
+                raise
+            finally:
+                if connection.closed or connection.broken:
+                    connection.close()
+                else:
+                    self._idle.put((connection, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _get(self) -> psycopg.Connection:
+        while True:
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if connection.closed or connection.broken:
+                connection.close()
+                continue
+            if time.monotonic() - last_used < HEALTH_CHECK_IDLE_SECONDS:
+                return connection
+            try:
+                connection.execute("SELECT 1")
+                connection.rollback()
+                return connection
+            except psycopg.Error:
+                connection.close()
+
+    def _connect(self) -> psycopg.Connection:
+        # 接続はCONNECT_TIMEOUT_SECONDSかかることがあるので、ロックは間隔の判定と更新だけに使う
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_attempt:
+                raise psycopg.OperationalError(
+                    f"Database unavailable, next attempt in {self._next_attempt - now:.0f}s"
+                )
+        try:
+            connection = psycopg.connect(CONNINFO)
+        except psycopg.Error:
+            with self._lock:
+                self._next_attempt = time.monotonic() + self._delay
+                self._delay = min(self._delay * 2, RECONNECT_MAX_SECONDS)
+            raise
+        with self._lock:
+            self._next_attempt = 0.0
+            self._delay = RECONNECT_MIN_SECONDS
+        logger.info("Connected to database")
+        return connection
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            connection.close()
+
+
+# データベースには最初に使うときに接続する
+_pool = _Pool(POOL_SIZE)
+
+
+def connection():
+    """
+    プールからコネクションを借りるコンテキストマネージャ
+    例外で抜けた場合はロールバックされる
+    """
+    return _pool.connection()
+
+
+def close() -> None:
+    _pool.close()
+
+
+# 送信待ちの記録を溜めるローカルのSQLiteファイル
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_RETRY_MIN_SECONDS = 1.0
+OUTBOX_RETRY_MAX_SECONDS = 60.0
+
+_outbox_path = None
+_outbox_wakeup = threading.Event()
+_outbox_writer = None
+
+
+def init_outbox(path: str = "outbox.sqlite3") -> None:
+    """
+    記録の送信をバックグラウンドに回す
+    記録はまずローカルのファイルに追記され、送信できたものから消される
+    前回送信できずに残った記録も起動時に送り直す
+    """
+    global _outbox_path, _outbox_writer
+    _outbox_path = path
+    with _open_outbox() as outbox:
+        outbox.execute("PRAGMA journal_mode=WAL")
+        outbox.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                count INTEGER NOT NULL,
+                wide INTEGER NOT NULL
+            )
         """
-        SELECT id FROM members WHERE face_name = %s
-    """,
-        (name,),
-    )
-    result = cursor.fetchone()
-    id = result[0] if result else None
-    # SQL文を実行してlogsテーブルにmember_id, counts, wideを挿入
-    cursor.execute(
+        )
+        # データベースが受け付けなかった記録は再送せずにここへ移す
+        outbox.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox_failed (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                count INTEGER NOT NULL,
+                wide INTEGER NOT NULL,
+                error TEXT NOT NULL,
+                failed_at REAL NOT NULL
+            )
         """
-        INSERT INTO logs (member_id, counts, wide)
-        VALUES (%s, %s, %s)
-    """,
-        (id, count, wide),
-    )
-    connection.commit()
-    cursor.close()
+        )
+    if _outbox_writer is None:
+        _outbox_writer = threading.Thread(
+            target=_flush_loop, name="db-outbox-writer", daemon=True
+        )
+        _outbox_writer.start()
+    _outbox_wakeup.set()
+
+
+@contextmanager
+def _open_outbox():
+    outbox = sqlite3.connect(_outbox_path)
+    try:
+        with outbox:
+            yield outbox
+    finally:
+        outbox.close()
+
+
+@metrics.timed("db.enqueue")
+def enqueue_record(name, count, wide):
+    """
+    記録を送信待ちに追加する
+    ネットワークを待たずに返り、送信はバックグラウンドで行われる
+    """
+    with _open_outbox() as outbox:
+        outbox.execute(
+            "INSERT INTO outbox (name, count, wide) VALUES (?, ?, ?)",
+            (name, count, int(wide)),
+        )
+    _outbox_wakeup.set()
+
+
+def _flush_loop():
+    delay = OUTBOX_RETRY_MIN_SECONDS
+    while True:
+        _outbox_wakeup.wait()
+        _outbox_wakeup.clear()
+        try:
+            while flush_outbox():
+                pass
+            delay = OUTBOX_RETRY_MIN_SECONDS
+        except Exception as e:
+            # 接続の失敗や想定外の失敗でもスレッドを止めず、記録はファイルに残したまま
+            # 間隔を空けながら再送する
+            message = f"Failed to flush outbox, retrying in {delay:.0f}s"
+            if isinstance(e, psycopg.OperationalError):
+                logger.warning(f"{message}: {e}")
+            else:
+                logger.exception(message)
+            retry = threading.Timer(delay, _outbox_wakeup.set)
+            retry.daemon = True
+            retry.start()
+            delay = min(delay * 2, OUTBOX_RETRY_MAX_SECONDS)
+
+
+# 送り直しても通らないエラー。これ以外は記録をファイルに残したまま再送する
+PERMANENT_ERRORS = (psycopg.IntegrityError, psycopg.DataError)
+
+
+@metrics.timed("db.flush")
+def flush_outbox() -> int:
+    """
+    送信待ちの記録を1バッチ分データベースに書き込み、処理した件数を返す
+    データベースが受け付けない記録はoutbox_failedに移し、残りの送信を止めない
+    """
+    with _open_outbox() as outbox:
+        rows = outbox.execute(
+            "SELECT id, name, count, wide FROM outbox ORDER BY id LIMIT ?",
+            (OUTBOX_BATCH_SIZE,),
+        ).fetchall()
+        if not rows:
+            return 0
+        try:
+            register_records(
+                [(name, count, bool(wide)) for _, name, count, wide in rows]
+            )
+        except PERMANENT_ERRORS as e:
+            logger.warning(f"Outbox batch rejected, retrying row by row: {e}")
+            _flush_rows(outbox, rows)
+            return len(rows)
+        # データベースへのコミット後に消すので、ここで落ちても記録は失われない
+        outbox.executemany(
+            "DELETE FROM outbox WHERE id = ?", [(id,) for id, *_ in rows]
+        )
+    logger.info(f"Flushed {len(rows)} records from outbox")
+    return len(rows)
+
+
+def _flush_rows(outbox: sqlite3.Connection, rows) -> None:
+    # どの記録が受け付けられないのかを1件ずつ送って切り分ける
+    # 1件ごとにコミットするので、途中で接続が切れても送れた分は二重に送らない
+    for id, name, count, wide in rows:
+        try:
+            register_records([(name, count, bool(wide))])
+        except PERMANENT_ERRORS as e:
+            logger.error(
+                f"Moving record {id} ({name}, {count}, {bool(wide)}) "
+                f"to outbox_failed: {e}"
+            )
+            outbox.execute(
+                """
+                INSERT INTO outbox_failed (id, name, count, wide, error, failed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (id, name, count, wide, str(e), time.time()),
+            )
+        outbox.execute("DELETE FROM outbox WHERE id = ?", (id,))
+        outbox.commit()
+
+
+INSERT_RECORD_SQL = """
+    INSERT INTO logs (member_id, counts, wide)
+    VALUES ((SELECT id FROM members WHERE face_name = %s), %s, %s)
+"""
+SELECT_MEMBER_SQL = """
+    SELECT id, nickname FROM members WHERE face_name = %s
+"""
+
+
+def register_records(records):
+    """
+    (name, count, wide)のリストをまとめて書き込む
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.executemany(INSERT_RECORD_SQL, records)
+        conn.commit()
+
+
+def register_record(name, count, wide):
+    # membersテーブルのidの引き当てと挿入を1つの文で行う
+    register_records([(name, count, wide)])
+
+
+# face_name -> (読み込んだ時刻, id, nickname)
+MEMBER_CACHE_SIZE = 1024
+MEMBER_CACHE_TTL_SECONDS = 600
+# 新しく登録された人もキャッシュに載るように、裏で先読みし直す間隔
+MEMBER_PRELOAD_INTERVAL_SECONDS = 300
+
+_members: OrderedDict[str, tuple[float, int | None, str | None]] = OrderedDict()
+_members_lock = threading.Lock()
+# 裏で読み直している最中のface_name
+_refreshing: set[str] = set()
+
+
+def preload_members(background: bool = True) -> None:
+    """
+    membersテーブルを先読みし、顔認証の直後にニックネームを待たずに出せるようにする
+    backgroundなら裏でMEMBER_PRELOAD_INTERVAL_SECONDSごとに繰り返す
+    """
+    if background:
+        threading.Thread(target=_preload_loop, name="db-preload", daemon=True).start()
+        return
+    try:
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT face_name, id, nickname FROM members LIMIT %s
+            """,
+                (MEMBER_CACHE_SIZE,),
+            )
+            rows = cursor.fetchall()
+            conn.rollback()
+    except psycopg.Error as e:
+        logger.warning(f"Failed to preload members: {e}")
+        return
+    now = time.monotonic()
+    with _members_lock:
+        for face_name, id, nickname in rows:
+            _members[face_name] = (now, id, nickname)
+    logger.info(f"Preloaded {len(rows)} members")
+
+
+def _preload_loop() -> None:
+    while True:
+        preload_members(background=False)
+        time.sleep(MEMBER_PRELOAD_INTERVAL_SECONDS)
+
+
+@metrics.timed("db.lookup")
+def lookup_member(name) -> tuple[int | None, str | None]:
+    """
+    (id, nickname)を返す。登録されていなければ(None, None)
+    キャッシュが古ければそれを返して裏で読み直し、無い場合だけデータベースを待つ
+    """
+    cached = cached_member(name, refresh_stale=True)
+    if cached is not None:
+        return cached
+    return _select_member(name)
+
+
+def _select_member(name) -> tuple[int | None, str | None]:
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(SELECT_MEMBER_SQL, (name,))
+        result = cursor.fetchone()
+        conn.rollback()
+    return store_member(name, result)
+
+
+def cached_member(
+    name, refresh_stale: bool = False
+) -> tuple[int | None, str | None] | None:
+    """
+    キャッシュにある新しい(id, nickname)を返す。無ければNone
+    refresh_staleなら古いものも返し、裏でデータベースから読み直す
+    """
+    with _members_lock:
+        cached = _members.get(name)
+        if cached is None:
+            return None
+        stale = time.monotonic() - cached[0] >= MEMBER_CACHE_TTL_SECONDS
+        if stale and not refresh_stale:
+            return None
+        _members.move_to_end(name)
+        if stale and name not in _refreshing:
+            _refreshing.add(name)
+            threading.Thread(
+                target=_refresh_member, args=(name,), name="db-refresh", daemon=True
+            ).start()
+    return cached[1:]
+
+
+def _refresh_member(name) -> None:
+    try:
+        _select_member(name)
+    except psycopg.Error as e:
+        logger.warning(f"Failed to refresh member {name}: {e}")
+    finally:
+        with _members_lock:
+            _refreshing.discard(name)
+
+
+def store_member(name, result) -> tuple[int | None, str | None]:
+    """
+    SELECT_MEMBER_SQLの結果をキャッシュに入れ、(id, nickname)を返す
+    """
+    id, nickname = result if result else (None, None)
+    with _members_lock:
+        _members[name] = (time.monotonic(), id, nickname)
+        _members.move_to_end(name)
+        while len(_members) > MEMBER_CACHE_SIZE:
+            _members.popitem(last=False)
+    return id, nickname
+
+
+def invalidate_members(name=None) -> None:
+    """
+    membersテーブルを変更したときに呼ぶ。nameを省略すると全員分を捨てる
+    """
+    with _members_lock:
+        if name is None:
+            _members.clear()
+        else:
+            _members.pop(name, None)
 
 
 def get_nickname(name):
-    cursor = connection.cursor()
-    cursor.execute(
-        """
-        SELECT nickname FROM members WHERE face_name = %s
-    """,
-        (name,),
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    return result[0] if result else name
+    try:
+        _, nickname = lookup_member(name)
+    except psycopg.Error as e:
+        logger.warning(f"Failed to look up nickname of {name}: {e}")
+        return name
+    return nickname if nickname else name
+
+
+_lookup_executor: ThreadPoolExecutor | None = None
+
+
+def get_nickname_async(name) -> Future:
+    """
+    get_nicknameの結果を返すFutureを返す。描画のスレッドからはこちらを使う
+    キャッシュにあれば完了済みのFutureを返し、無ければ裏でデータベースに問い合わせる
+    """
+    global _lookup_executor
+    cached = cached_member(name, refresh_stale=True)
+    if cached is not None:
+        future = Future()
+        future.set_result(cached[1] if cached[1] else name)
+        return future
+    if _lookup_executor is None:
+        _lookup_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db-lookup"
+        )
+    return _lookup_executor.submit(get_nickname, name)
@@ -0,0 +1,165 @@
+"""
+dbモジュールのasyncio版
+
+ゲームループとは別のイベントループから使い、
+データベースの待ち時間をカメラや推論と重ねられるようにする
+接続設定、SQL、メンバーのキャッシュはdbモジュールと共有する
+"""
+
+import asyncio
+import logging
+import time
+
+import psycopg
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncPool:
+    """
+    必要になったときに接続する小さな非同期コネクションプール
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._idle: list[tuple[psycopg.AsyncConnection, float]] = []
+        self._slots: asyncio.Semaphore | None = None
+
+    async def _acquire(self) -> psycopg.AsyncConnection:
+        # Semaphoreは使うイベントループの中で作る
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._size)
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if connection.closed or connection.broken:
+                    await connection.close()
+                    continue
+                if time.monotonic() - last_used < db.HEALTH_CHECK_IDLE_SECONDS:
+                    return connection
+                try:
+                    await connection.execute("SELECT 1")
+                    await connection.rollback()
+                    return connection
+                except psycopg.Error:
+                    await connection.close()
+            return await psycopg.AsyncConnection.connect(db.CONNINFO)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _release(self, connection: psycopg.AsyncConnection) -> None:
+        if connection.closed or connection.broken:
+            await connection.close()
+        else:
+            self._idle.append((connection, time.monotonic()))
+        self._slots.release()
+
+    def connection(self) -> "_Lease":
+        return _Lease(self)
+
+    async def close(self) -> None:
+        while self._idle:
+            connection, _ = self._idle.pop()
+            await connection.close()
+
+
+class _Lease:
+    def __init__(self, pool: _AsyncPool):
+        self._pool = pool
+        self._connection: psycopg.AsyncConnection | None = None
+
+    async def __aenter__(self) -> psycopg.AsyncConnection:
+        self._connection = await self._pool._acquire()
+        return self._connection
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        connection = self._connection
+        if exc_type is not None and not (connection.closed or connection.broken):
+            await connection.rollback()
+        await self._pool._release(connection)
+
+
+_pool = _AsyncPool(db.POOL_SIZE)
+
+
+def connection() -> _Lease:
+    """
+    プールからコネクションを借りる非同期コンテキストマネージャ
+    """
+    return _pool.connection()
+
+
+async def close() -> None:
+    await _pool.close()
+
+
+async def register_record(name, count, wide):
+    await register_records_pipelined([(name, count, wide)])
+
+
+async def register_records_pipelined(records):
+    """
+    (name, count, wide)のリストをexecutemanyでまとめて書き込む
+    psycopgはパイプラインで送るので、件数に比例した往復は発生しない
+    """
+    async with connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.executemany(db.INSERT_RECORD_SQL, records)
+        await conn.commit()
+
+
+async def register_records(records):
+    """
+    オフラインだったキオスクの記録など、大量の(name, count, wide)をCOPYで書き込む
+    memberのidは1回の問い合わせでまとめて引き当てる
+    """
+    names = list({name for name, _, _ in records if name is not None})
+    async with connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                """
+                SELECT face_name, id FROM members WHERE face_name = ANY(%s)
+            """,
+                (names,),
+            )
+            ids = dict(await cursor.fetchall())
+            async with cursor.copy(
+                "COPY logs (member_id, counts, wide) FROM STDIN"
+            ) as copy:
+                for name, count, wide in records:
+                    await copy.write_row((ids.get(name), count, wide))
+        await conn.commit()
+    logger.info(f"Copied {len(records)} records")
+
+
+async def lookup_member(name) -> tuple[int | None, str | None]:
+    cached = db.cached_member(name, refresh_stale=True)
+    if cached is not None:
+        return cached
+
+    async with connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(db.SELECT_MEMBER_SQL, (name,))
+            result = await cursor.fetchone()
+        await conn.rollback()
+    return db.store_member(name, result)
+
+
+async def get_nickname(name):
+    try:
+        _, nickname = await lookup_member(name)
+    except psycopg.Error as e:
+        logger.warning(f"Failed to look up nickname of {name}: {e}")
+        return name
+    return nickname if nickname else name
+
+
+async def get_nicknames(names):
+    """
+    複数人のニックネームを並行して引く
+    """
+    return await asyncio.gather(*(get_nickname(name) for name in names))
@@ -1,46 +1,582 @@
 import json
 import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
 
 import cv2
 import face_recognition
 import numpy as np
 
+import capture
+import face_store
+import metrics
+
 logger = logging.getLogger(__name__)
 
-known_encodings = []
-known_names = []
+# 顔検出は縮小したフレームで行う
+DETECT_SCALE = 0.5
+# これより小さい顔(元の解像度のピクセル数)は特徴量を計算しない
+MIN_FACE_SIZE = 80
+# 特徴量は顔の周辺を切り出し、この大きさに拡大縮小してから計算する
+PATCH_SIZE = 150
+PATCH_MARGIN = 0.25
+# 前のフレームの顔とのIoUがこれ以上なら同じ顔とみなす
+STABLE_IOU = 0.6
+# 縮小したグレースケール画像の平均差分がこれ未満なら変化なしとみなす
+STILL_THRESHOLD = 2.0
+# 本人の確定に必要な、特徴量を計算したフレームの数
+# 変化がなくても、顔ごとにこの回数までは特徴量を計算する
+MIN_VOTE_FRAMES = 2
 
+INDEX_TYPES = ("flat", "ivf")
+# ivfインデックスで1つの顔について調べるクラスタの数
+IVF_PROBES = 4
 
-def init(face_features_path: str) -> None:
-    global known_encodings
-    global known_names
-    with open(face_features_path, "r") as f:
-        known_faces = json.load(f)
-    known_encodings = [face["encoding"] for face in known_faces]
-    known_names = [face["name"] for face in known_faces]
+
+class Gallery:
+    """
+    登録済みの顔特徴量を1つの行列として保持し、複数の顔をまとめて照合する
+
+    1人につき複数の特徴量を登録でき、その人との距離は最も近い特徴量との距離になる
+    """
+
+    def __init__(
+        self,
+        encodings: np.ndarray,
+        labels: np.ndarray,
+        names: list[str],
+        sq_norms: np.ndarray | None = None,
+    ):
+        """
+        labelsは昇順に並んでいること(同じ人の行が連続していること)
+        人ごとの最小値をreduceatで取るためで、並べ替えはfrom_entriesで行う
+        読み込み専用のmemmapをそのまま受け取れるよう、配列はコピーしない
+        """
+        self.encodings = encodings
+        self.labels = labels
+        self.names = names
+        if sq_norms is None:
+            sq_norms = np.einsum("ij,ij->i", encodings, encodings)
+        self.sq_norms = sq_norms
+        self._starts = np.searchsorted(labels, np.arange(len(names)))
+        self._index = {name: i for i, name in enumerate(names)}
+        self.centroids: np.ndarray | None = None
+        self._assignment: np.ndarray | None = None
+        self._cluster_rows: list[np.ndarray] = []
+
+    @classmethod
+    def from_entries(cls, entries: list[dict]) -> "Gallery":
+        """
+        {"name": ..., "encoding": [...]} もしくは {"name": ..., "encodings": [[...], ...]}
+        のリストから作る。特徴量が1つも無い人があればValueError
+        """
+        names: list[str] = []
+        index: dict[str, int] = {}
+        rows = []
+        labels = []
+        for entry in entries:
+            encodings = entry.get("encodings") or [entry.get("encoding")]
+            if not all(encodings):
+                raise ValueError(f"Face encodings of {entry['name']} are empty")
+            label = index.setdefault(entry["name"], len(names))
+            if label == len(names):
+                names.append(entry["name"])
+            rows.extend(encodings)
+            labels.extend([label] * len(encodings))
+        encodings = np.asarray(rows, dtype=np.float32).reshape(-1, 128)
+        labels = np.asarray(labels, dtype=np.int32)
+        order = np.argsort(labels, kind="stable")
+        return cls(np.ascontiguousarray(encodings[order]), labels[order], names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def build_index(self, n_clusters: int | None = None, iterations: int = 10) -> None:
+        """
+        特徴量をk-meansでクラスタに分け、照合時は近いクラスタだけを調べるようにする
+        数千人規模の登録を想定した近似検索で、少人数ではflatの方が速い
+        """
+        n_rows = len(self.encodings)
+        n_clusters = n_clusters or max(1, int(np.sqrt(n_rows)))
+        n_clusters = min(n_clusters, n_rows)
+        if n_clusters == 0:
+            return
+        rng = np.random.default_rng(0)
+        centroids = self.encodings[rng.choice(n_rows, n_clusters, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = _squared_distances(
+                self.encodings, self.sq_norms, centroids
+            ).argmin(axis=1)
+            for k in range(n_clusters):
+                members = self.encodings[assignment == k]
+                if len(members):
+                    centroids[k] = members.mean(axis=0)
+        self._set_index(centroids, assignment)
+        logger.info(f"Built face index with {n_clusters} clusters")
+
+    def _set_index(self, centroids: np.ndarray, assignment: np.ndarray) -> None:
+        self.centroids = centroids
+        self._assignment = assignment
+        self._cluster_rows = [
+            np.flatnonzero(assignment == k) for k in range(len(centroids))
+        ]
+
+    def member_encodings(self, name: str) -> np.ndarray | None:
+        label = self._index.get(name)
+        if label is None:
+            return None
+        start = self._starts[label]
+        end = self._starts[label + 1] if label + 1 < len(self.names) else None
+        return self.encodings[start:end]
+
+    def with_changes(
+        self, added: dict[str, np.ndarray], removed: set[str]
+    ) -> "Gallery":
+        """
+        追加・削除を反映した新しいGalleryを返す(自身は変更しない)
+        addedに登録済みの名前があれば、その人の特徴量を置き換える。特徴量が空ならValueError
+        インデックスはクラスタを作り直さず、新しい行を最も近いクラスタに割り当てる
+        """
+        for name, encodings in added.items():
+            # 行の無い人がいると、人ごとの先頭の行の位置が重なってreduceatが壊れる
+            if np.size(encodings) == 0:
+                raise ValueError(f"Face encodings of {name} are empty")
+        dropped = [self._index.get(name) for name in set(removed) | set(added)]
+        dropped = [label for label in dropped if label is not None]
+        keep = ~np.isin(self.labels, dropped)
+        kept_names = [name for name in self.names if name not in removed | added.keys()]
+
+        # 残る人の番号を詰め直す(並び順は保たれるのでlabelsは昇順のまま)
+        remap = np.full(len(self.names), -1, dtype=np.int32)
+        remap[[self._index[name] for name in kept_names]] = np.arange(len(kept_names))
+
+        new_rows = [
+            np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+            for encodings in added.values()
+        ]
+        new_labels = [
+            np.full(len(rows), len(kept_names) + i, dtype=np.int32)
+            for i, rows in enumerate(new_rows)
+        ]
+        added_encodings = np.concatenate(
+            new_rows or [np.empty((0, 128), dtype=np.float32)]
+        )
+        added_sq_norms = np.einsum("ij,ij->i", added_encodings, added_encodings)
+
+        result = Gallery(
+            np.concatenate([self.encodings[keep], added_encodings]),
+            np.concatenate([remap[self.labels[keep]], *new_labels]),
+            kept_names + list(added),
+            np.concatenate([self.sq_norms[keep], added_sq_norms]),
+        )
+        if self.centroids is not None:
+            added_assignment = _squared_distances(
+                added_encodings, added_sq_norms, self.centroids
+            ).argmin(axis=1)
+            result._set_index(
+                self.centroids,
+                np.concatenate([self._assignment[keep], added_assignment]),
+            )
+        return result
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        各顔(行)と各登録者(列)の距離を返す
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, 128)
+        if len(self.names) == 0:
+            return np.empty((len(queries), 0), dtype=np.float32)
+        if self.centroids is None:
+            squared = _squared_distances(queries, None, self.encodings, self.sq_norms)
+            return np.minimum.reduceat(np.sqrt(squared), self._starts, axis=1)
+        return self._distances_ivf(queries)
+
+    def _distances_ivf(self, queries: np.ndarray) -> np.ndarray:
+        result = np.full((len(queries), len(self.names)), np.inf, dtype=np.float32)
+        probes = min(IVF_PROBES, len(self.centroids))
+        nearest = np.argsort(_squared_distances(queries, None, self.centroids), axis=1)[
+            :, :probes
+        ]
+        for i, clusters in enumerate(nearest):
+            rows = np.concatenate([self._cluster_rows[k] for k in clusters])
+            squared = _squared_distances(
+                queries[i : i + 1], None, self.encodings[rows], self.sq_norms[rows]
+            )[0]
+            np.minimum.at(result[i], self.labels[rows], np.sqrt(squared))
+        return result
+
+    def match(self, queries: np.ndarray, threshold: float) -> list[str | None]:
+        """
+        各顔について、閾値以内で最も近い登録者の名前を返す
+        """
+        distances = self.distances(queries)
+        if distances.shape[1] == 0:
+            return [None] * len(distances)
+        best = distances.argmin(axis=1)
+        return [
+            self.names[j] if distances[i, j] <= threshold else None
+            for i, j in enumerate(best)
+        ]
+
+
+def _squared_distances(
+    a: np.ndarray,
+    a_sq_norms: np.ndarray | None,
+    b: np.ndarray,
+    b_sq_norms: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    |a - b|^2 = |a|^2 + |b|^2 - 2a・b を行列積でまとめて計算する
+    """
+    if a_sq_norms is None:
+        a_sq_norms = np.einsum("ij,ij->i", a, a)
+    if b_sq_norms is None:
+        b_sq_norms = np.einsum("ij,ij->i", b, b)
+    squared = a_sq_norms[:, None] + b_sq_norms[None, :] - 2 * (a @ b.T)
+    return np.maximum(squared, 0, out=squared)
+
+
+# 照合側は参照を1回読むだけなので、差し替えの途中の状態を見ることはない
+gallery: Gallery | None = None
+_update_lock = threading.Lock()
+_watcher: threading.Thread | None = None
+
+
+def init(
+    face_features_path: str, index: str = "flat", watch_interval: float = 0.0
+) -> None:
+    """
+    watch_intervalが正の場合、その間隔で特徴量ファイルの更新を監視し、
+    追加・削除された人だけを反映する
+    """
+    global gallery, _watcher
+    if index not in INDEX_TYPES:
+        raise ValueError(f"Unknown face index: {index}")
+    gallery = load_gallery(face_features_path)
+    if index == "ivf":
+        gallery.build_index()
     logger.info(
-        f"Loaded {len(known_encodings)} known face encodings from {face_features_path}"
+        f"Loaded {len(gallery.encodings)} known face encodings of {len(gallery)} members"
+        f" from {face_features_path}"
     )
+    if watch_interval > 0 and _watcher is None:
+        _watcher = threading.Thread(
+            target=_watch,
+            args=(face_features_path, watch_interval),
+            name="face-gallery-watcher",
+            daemon=True,
+        )
+        _watcher.start()
+
+
+def enroll(name: str, encodings: np.ndarray) -> None:
+    """
+    nameの特徴量を登録する(登録済みなら置き換える)
+    """
+    _apply({name: encodings}, set())
+
+
+def remove(name: str) -> None:
+    _apply({}, {name})
+
+
+def _apply(added: dict[str, np.ndarray], removed: set[str]) -> None:
+    global gallery
+    with _update_lock:
+        gallery = gallery.with_changes(added, removed)
+    logger.info(f"Face gallery updated: +{list(added)} -{sorted(removed)}")
+
+
+def _watch(face_features_path: str, interval: float) -> None:
+    def signature():
+        stat = os.stat(face_features_path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    last = signature()
+    while True:
+        time.sleep(interval)
+        try:
+            current = signature()
+            if current == last:
+                continue
+            last = current
+            _reload(face_features_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to reload face features: {e}")
+
+
+def _reload(face_features_path: str) -> None:
+    """
+    ファイルを読み直し、現在のギャラリーとの差分だけを反映する
+    """
+    loaded = load_gallery(face_features_path)
+    current = gallery
+    removed = set(current.names) - set(loaded.names)
+    added = {}
+    for name in loaded.names:
+        encodings = loaded.member_encodings(name)
+        if not np.array_equal(current.member_encodings(name), encodings):
+            added[name] = np.array(encodings)
+    if added or removed:
+        _apply(added, removed)
+
+
+def load_gallery(face_features_path: str) -> Gallery:
+    """
+    拡張子が.binならface_storeのバイナリ形式をメモリマップで、それ以外はJSONで読み込む
+    """
+    if os.path.splitext(face_features_path)[1] == face_store.EXTENSION:
+        return Gallery(*face_store.load(face_features_path))
+    with open(face_features_path, "r") as f:
+        known_faces = json.load(f)
+    return Gallery.from_entries(known_faces)
+
+
+@dataclass
+class FaceObservation:
+    """
+    1フレームで見えた顔
+    distancesはこのフレームで特徴量を計算した場合だけ、近い順に最大TOP_K人分入る
+    name, distanceはその顔について最後に計算した最も近い登録者
+    """
+
+    track_id: int
+    box: tuple[int, int, int, int]  # (top, right, bottom, left)
+    distances: dict[str, float]
+    name: str | None = None
+    distance: float = float("inf")
+
+
+# FaceObservation.distancesに入れる人数
+TOP_K = 5
+
 
+@dataclass
+class _Track:
+    id: int
+    box: tuple[int, int, int, int]
+    name: str | None = None
+    distance: float = float("inf")
+    encodings: int = 0
 
-def recognize_face_names(frame: cv2.Mat, threshold: float = 0.6):
+
+_tracks: list[_Track] = []
+_next_track_id = 0
+_last_small: np.ndarray | None = None
+
+
+def reset_tracking() -> None:
+    """
+    セッションの開始時に呼び、前のセッションの顔と比較用のフレームを捨てる
+    推論と同じスレッドかプロセスで呼ぶこと
+    """
+    global _tracks, _last_small
+    _tracks = []
+    _last_small = None
+
+
+def recognize_face_names(frame: capture.FrameContext, threshold: float = 0.6):
     """
     frameに含まれる顔を識別する
     """
-    global known_encodings
-    global known_names
+    return [
+        observation.name
+        for observation in recognize_faces(frame, max_encodings=1)
+        if observation.name is not None and observation.distance <= threshold
+    ]
+
+
+@metrics.timed("face")
+def recognize_faces(
+    frame: capture.FrameContext, max_encodings: int | None = None
+) -> list[FaceObservation]:
+    """
+    frameに含まれる顔を検出し、登録者との距離を求める
+
+    縮小したフレームで顔を検出し、前のフレームの顔と位置で対応付ける
+    特徴量は位置が安定した十分大きな顔についてだけ、切り出した画像で計算する
+    1つの顔について特徴量を計算するのはmax_encodings回まで
+    フレームに変化がなければ検出もせずに前回の顔を返す
+    """
+    global _tracks, _next_track_id, _last_small
+
+    enough = MIN_VOTE_FRAMES
+    if max_encodings is not None:
+        enough = min(enough, max_encodings)
+    small = frame.resized(DETECT_SCALE)
+    small_gray = frame.resized(DETECT_SCALE, gray=True)
+    if _last_small is None or _last_small.shape != small_gray.shape:
+        still = False
+        _last_small = small_gray.copy()
+    else:
+        still = cv2.absdiff(small_gray, _last_small).mean() < STILL_THRESHOLD
+        # フレームのバッファは使い回されるので、自分のバッファに写しておく
+        np.copyto(_last_small, small_gray)
+    # 顔が1つも無いときは、静止していても新しく現れた顔を探す
+    if (
+        still
+        and _tracks
+        and all(
+            track.encodings >= enough or _face_size(track.box) < MIN_FACE_SIZE
+            for track in _tracks
+        )
+    ):
+        return [_observe(track, {}) for track in _tracks]
+
+    tracks = []
+    observations = []
+    for location in face_recognition.face_locations(small):
+        box = tuple(int(v / DETECT_SCALE) for v in location)
+        previous = max(_tracks, key=lambda t: _iou(t.box, box), default=None)
+        distances = {}
+        if previous is not None and _iou(previous.box, box) >= STABLE_IOU:
+            track = previous
+            track.box = box
+            if _face_size(box) >= MIN_FACE_SIZE and (
+                max_encodings is None or track.encodings < max_encodings
+            ):
+                distances = _encode_patch(frame.rgb(), box)
+                if distances:
+                    track.name, track.distance = next(iter(distances.items()))
+                track.encodings += 1
+        else:
+            # 初めて見えた顔は位置が落ち着くまで待つ
+            track = _Track(id=_next_track_id, box=box)
+            _next_track_id += 1
+        tracks.append(track)
+        observations.append(_observe(track, distances))
+    _tracks = tracks
+
+    return observations
+
+
+def _observe(track: _Track, distances: dict[str, float]) -> FaceObservation:
+    return FaceObservation(
+        track_id=track.id,
+        box=track.box,
+        distances=distances,
+        name=track.name,
+        distance=track.distance,
+    )
+
+
+def _encode_patch(frame: cv2.Mat, box: tuple[int, int, int, int]) -> dict[str, float]:
+    """
+    顔の周辺を切り出して特徴量を計算し、近い登録者から順に距離を返す
+    """
+    top, right, bottom, left = box
+    margin = int(_face_size(box) * PATCH_MARGIN)
+    height, width = frame.shape[:2]
+    y0, y1 = max(top - margin, 0), min(bottom + margin, height)
+    x0, x1 = max(left - margin, 0), min(right + margin, width)
+    patch = frame[y0:y1, x0:x1]
+    scale = PATCH_SIZE / max(patch.shape[:2])
+    patch = cv2.resize(patch, (0, 0), fx=scale, fy=scale)
+    location = (
+        int((top - y0) * scale),
+        int((right - x0) * scale),
+        int((bottom - y0) * scale),
+        int((left - x0) * scale),
+    )
+
+    encodings = face_recognition.face_encodings(patch, [location])
+    if not encodings:
+        return {}
+    current = gallery
+    distances = current.distances(np.asarray(encodings))[0]
+    k = min(TOP_K, len(distances))
+    nearest = np.argpartition(distances, k - 1)[:k] if k else []
+    nearest = sorted(nearest, key=lambda j: distances[j])
+    return {current.names[j]: float(distances[j]) for j in nearest}
+
+
+class IdentityVoter:
+    """
+    顔ごとに直近window回分の距離を積み上げ、本人を確定する
+
+    登録者ごとのスコアは距離の平均で、TOP_Kに入らなかったフレームでは
+    そのフレームのTOP_K内の最大の距離を入れる
+    最も近い人のスコアが閾値以内で、2位との差がmargin以上開いたら確定する
+    """
+
+    def __init__(
+        self,
+        window: int = 5,
+        threshold: float = 0.6,
+        margin: float = 0.08,
+        min_frames: int = MIN_VOTE_FRAMES,
+    ):
+        self.window = window
+        self.threshold = threshold
+        self.margin = margin
+        self.min_frames = min_frames
+        self._history: dict[int, list[dict[str, float]]] = {}
+
+    def add(self, observations: list[FaceObservation]) -> str | None:
+        """
+        観測を加え、一番大きく写っている顔の本人が確定すればその名前を返す
+        """
+        visible = {observation.track_id for observation in observations}
+        self._history = {
+            track_id: history
+            for track_id, history in self._history.items()
+            if track_id in visible
+        }
+        for observation in observations:
+            if observation.distances:
+                history = self._history.setdefault(observation.track_id, [])
+                history.append(observation.distances)
+                del history[: -self.window]
+
+        if not observations:
+            return None
+        nearest = max(observations, key=lambda o: _face_size(o.box))
+        history = self._history.get(nearest.track_id, [])
+        if len(history) < self.min_frames:
+            return None
+        ranking = sorted(self.scores(nearest.track_id).items(), key=lambda x: x[1])
+        best_name, best = ranking[0]
+        second = ranking[1][1] if len(ranking) > 1 else float("inf")
+        if best <= self.threshold and second - best >= self.margin:
+            return best_name
+        return None
+
+    def scores(self, track_id: int) -> dict[str, float]:
+        """
+        track_idの顔についての登録者ごとのスコア(小さいほど近い)
+        """
+        history = self._history.get(track_id, [])
+        names = {name for distances in history for name in distances}
+        return {
+            name: sum(
+                distances.get(name, max(distances.values())) for distances in history
+            )
+            / len(history)
+            for name in names
+        }
+
+    def all_scores(self) -> dict[int, dict[str, float]]:
+        return {track_id: self.scores(track_id) for track_id in self._history}
+
+    def reset(self) -> None:
+        self._history = {}
+
 
-    face_locations = face_recognition.face_locations(frame)
-    face_encodings = face_recognition.face_encodings(frame, face_locations)
+def _face_size(box: tuple[int, int, int, int]) -> int:
+    top, right, bottom, left = box
+    return min(bottom - top, right - left)
 
-    recognized_names = []
-    for encoding in face_encodings:
-        distances = face_recognition.face_distance(known_encodings, encoding)
-        best_match_index = np.argmin(distances)
-        if distances[best_match_index] <= threshold:
-            recognized_names.append(known_names[best_match_index])
 
-    return recognized_names
+def _iou(a: tuple[int, int, int, int], b: tuple[int, int, int, int]) -> float:
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    intersection = max(bottom - top, 0) * max(right - left, 0)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
 
 
 if __name__ == "__main__":
@@ -59,6 +595,7 @@ if __name__ == "__main__":
 
     init(sys.argv[2] if len(sys.argv) > 2 else "assets/face_features.json")
 
+    seq = 0
     while True:
         start_time = time.time()
 
@@ -66,10 +603,12 @@ if __name__ == "__main__":
         if not ret:
             logger.error("Failed to read frame from video capture")
             break
-        frame = cv2.resize(frame, (0, 0), fx=0.3, fy=0.3)
         logger.info(frame.shape)
+        seq += 1
 
-        names = recognize_face_names(frame, threshold=0.6)
+        names = recognize_face_names(
+            capture.FrameContext(frame, time.monotonic(), seq), threshold=0.6
+        )
         for name in names:
             logger.info(f"Recognized name: {name}")
 
@@ -0,0 +1,107 @@
+"""
+顔特徴量のバイナリ形式
+
+起動のたびに大きなJSONを解析しなくて済むよう、特徴量を行列のまま保存し、
+読み込み専用のメモリマップとして開く
+同じマシンの複数プロセスで開いてもページは共有される
+
+レイアウト(リトルエンディアン)：
+- ヘッダ(64バイト)：マジック、バージョン、行数、次元数、人数
+- 特徴量 float32[行数, 次元数]
+- 特徴量のノルムの2乗 float32[行数]
+- 各行の人の番号 int32[行数] (昇順)
+- 名前 UTF-8を改行区切りで連結したもの
+"""
+
+import logging
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EXTENSION = ".bin"
+MAGIC = b"KFG1"
+VERSION = 1
+HEADER = struct.Struct("<4sIIII")
+HEADER_SIZE = 64
+
+
+def save(
+    path: str,
+    encodings: np.ndarray,
+    labels: np.ndarray,
+    names: list[str],
+    sq_norms: np.ndarray,
+) -> None:
+    """
+    labelsは昇順に並んでいること
+    """
+    encodings = np.ascontiguousarray(encodings, dtype="<f4")
+    rows, dim = encodings.shape
+    # 読み込み中のプロセスがマップしているファイルを書き換えないよう、
+    # 別のファイルに書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            HEADER.pack(MAGIC, VERSION, rows, dim, len(names)).ljust(HEADER_SIZE, b"\0")
+        )
+        f.write(encodings.tobytes())
+        f.write(np.ascontiguousarray(sq_norms, dtype="<f4").tobytes())
+        f.write(np.ascontiguousarray(labels, dtype="<i4").tobytes())
+        f.write("\n".join(names).encode("utf-8"))
+    os.replace(tmp_path, path)
+
+
+def load(path: str) -> tuple[np.ndarray, np.ndarray, list[str], np.ndarray]:
+    """
+    (特徴量, 人の番号, 名前, ノルムの2乗) を返す
+    配列はファイルを読み込み専用でマップしたもので、読み込みは行数によらない
+    """
+    with open(path, "rb") as f:
+        magic, version, rows, dim, n_names = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported face feature file: {path}")
+        names_offset = HEADER_SIZE + rows * dim * 4 + rows * 4 * 2
+        f.seek(names_offset)
+        names = f.read().decode("utf-8").split("\n") if n_names else []
+    if len(names) != n_names:
+        raise ValueError(f"Corrupted names table in {path}")
+
+    offset = HEADER_SIZE
+    if rows == 0:
+        encodings = np.empty((0, dim), dtype="<f4")
+        sq_norms = np.empty(0, dtype="<f4")
+        labels = np.empty(0, dtype="<i4")
+        return encodings, labels, names, sq_norms
+    encodings = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(rows, dim))
+    offset += rows * dim * 4
+    sq_norms = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(rows,))
+    offset += rows * 4
+    labels = np.memmap(path, dtype="<i4", mode="r", offset=offset, shape=(rows,))
+    return encodings, labels, names, sq_norms
+
+
+if __name__ == "__main__":
+    """JSONの特徴量ファイルを変換する"""
+    import json
+    import sys
+
+    import face
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 3:
+        logger.error("Usage: face_store.py <face_features.json> <face_features.bin>")
+        exit(1)
+
+    with open(sys.argv[1], "r") as f:
+        gallery = face.Gallery.from_entries(json.load(f))
+    save(
+        sys.argv[2], gallery.encodings, gallery.labels, gallery.names, gallery.sq_norms
+    )
+    logger.info(
+        f"Converted {len(gallery.encodings)} encodings of {len(gallery)} members"
+        f" to {sys.argv[2]}"
+    )
@@ -0,0 +1,105 @@
+"""
+ランドマークの平滑化
+
+One Euro Filterで、静止しているときは強く、速く動いているときは弱くノイズを抑える
+時刻の差で計算するので、フレームレートが変わったりフレームが間引かれたりしても特性は変わらない
+回数の判定で使うのは--rep-detector peakの場合だけで、thresholdでは平滑化しない
+"""
+
+import dataclasses
+import math
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from pose import PoseDetectionResult
+
+# 顔が上下する程度の速さに合わせた値(座標は画面に対する割合、時間は秒)
+MIN_CUTOFF = 1.0
+BETA = 20.0
+DERIVATIVE_CUTOFF = 1.0
+# この時間以上見失っていた点は、前の値を引き継がずにやり直す
+MAX_GAP_MS = 500
+
+
+def _alpha(cutoff: float, dt: float) -> float:
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    def __init__(
+        self,
+        min_cutoff: float = MIN_CUTOFF,
+        beta: float = BETA,
+        d_cutoff: float = DERIVATIVE_CUTOFF,
+    ):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self) -> None:
+        self.value: np.ndarray | None = None
+        # 1秒あたりの変化量
+        self.velocity: np.ndarray | None = None
+        self._timestamp_ms: float | None = None
+
+    def __call__(self, x, timestamp_ms: float) -> np.ndarray:
+        x = np.asarray(x, dtype=np.float64)
+        if self.value is None:
+            self.value = x
+            self.velocity = np.zeros_like(x)
+            self._timestamp_ms = timestamp_ms
+            return self.value
+
+        dt = (timestamp_ms - self._timestamp_ms) / 1000
+        if dt <= 0:
+            return self.value
+        self._timestamp_ms = timestamp_ms
+
+        velocity = (x - self.value) / dt
+        self.velocity = self.velocity + _alpha(self.d_cutoff, dt) * (
+            velocity - self.velocity
+        )
+        cutoff = self.min_cutoff + self.beta * np.abs(self.velocity)
+        self.value = self.value + _alpha(cutoff, dt) * (x - self.value)
+        return self.value
+
+
+class LandmarkSmoother:
+    """
+    PoseDetectionResultの鼻と両手首をそれぞれ平滑化する
+    """
+
+    FIELDS = ("nose", "left_hand", "right_hand")
+
+    def __init__(self, **kwargs):
+        self._filters = {field: OneEuroFilter(**kwargs) for field in self.FIELDS}
+        self._seen_ms: dict[str, float] = {}
+
+    def __call__(
+        self, result: "PoseDetectionResult", timestamp_ms: float
+    ) -> "PoseDetectionResult":
+        if result is None:
+            return result
+        smoothed = {}
+        for field in self.FIELDS:
+            point = getattr(result, field)
+            if point is None:
+                smoothed[field] = None
+                continue
+            f = self._filters[field]
+            if timestamp_ms - self._seen_ms.get(field, -math.inf) > MAX_GAP_MS:
+                f.reset()
+            self._seen_ms[field] = timestamp_ms
+            smoothed[field] = tuple(float(v) for v in f(point, timestamp_ms))
+        return dataclasses.replace(result, **smoothed)
+
+    def velocity(self, field: str) -> tuple[float, float] | None:
+        """
+        fieldの点の1秒あたりの移動量
+        """
+        velocity = self._filters[field].velocity
+        return None if velocity is None else (float(velocity[0]), float(velocity[1]))
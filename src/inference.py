@@ -0,0 +1,134 @@
+"""
+推論をゲームループから切り離して実行する
+
+フェーズは最新のフレームを投げ込み、完了済みの最新の結果だけを受け取る
+結果はフレームの通し番号付きで返り、古いものは捨てられる
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import capture
+import metrics
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = ("thread", "process")
+
+
+def _timed_call(fn: Callable[..., Any], *args) -> tuple[Any, float]:
+    # ワーカーの中で測るので、受け渡しや結果を受け取るまでの待ち時間は含まない
+    start = time.perf_counter()
+    value = fn(*args)
+    return value, (time.perf_counter() - start) * 1000
+
+
+@dataclass
+class InferenceResult:
+    seq: int
+    frame: capture.FrameContext
+    value: Any
+
+
+class InferenceWorker:
+    """
+    推論関数を1つのワーカーで実行する
+
+    dlibのようにGILを解放する処理はthread、
+    GILを握ったままの処理はprocessを選ぶ
+    processの場合はinitializerで子プロセス側のモデルを初期化する
+    fnにはフレームをFrameContextのまま渡し、必要な形式への変換はfn側で行う
+    """
+
+    def __init__(
+        self,
+        fn: Callable[..., Any],
+        kind: str = "thread",
+        initializer: Callable[..., None] | None = None,
+        initargs: tuple = (),
+    ):
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f"inference-{fn.__module__}",
+                initializer=initializer,
+                initargs=initargs,
+            )
+        elif kind == "process":
+            # pygameやカメラのスレッドを抱えたままforkしないようにspawnする
+            self._executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer,
+                initargs=initargs,
+            )
+        else:
+            raise ValueError(f"Unknown executor: {kind}")
+        self._fn = fn
+        self.name = f"inference.{fn.__module__}"
+        # 最後に完了した推論にかかった時間と、完了した推論の数
+        self.last_latency_ms: float | None = None
+        self.completed = 0
+        self._future: Future | None = None
+        self._pending: capture.FrameContext | None = None
+        self._submitted_seq = 0
+        self._min_seq = 0
+
+    @property
+    def busy(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def submit(self, frame: capture.FrameContext, *args) -> bool:
+        """
+        ワーカーが空いていればframeの推論を始める
+        推論中か、完了した結果がまだpoll()で受け取られていない場合、
+        もしくは同じフレームを投げ済みの場合は何もしない
+        """
+        if self._future is not None or frame.seq <= self._submitted_seq:
+            return False
+        self._pending = frame
+        self._submitted_seq = frame.seq
+        self._future = self._executor.submit(_timed_call, self._fn, frame, *args)
+        return True
+
+    def reconfigure(self, fn: Callable[..., Any], *args) -> None:
+        """
+        推論と同じワーカーでfnを実行する
+        モデルの作り直しなど、推論と並行して行えない処理に使う
+        """
+        self._executor.submit(fn, *args)
+
+    def poll(self) -> InferenceResult | None:
+        """
+        新しく完了した結果があれば返す
+        """
+        if self._future is None or not self._future.done():
+            return None
+        future, frame = self._future, self._pending
+        self._future = None
+        self._pending = None
+
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Inference failed on frame {frame.seq}: {error!r}")
+            return None
+        value, self.last_latency_ms = future.result()
+        self.completed += 1
+        metrics.record(self.name, self.last_latency_ms)
+        if frame.seq <= self._min_seq:
+            logger.debug(f"Discarding stale result for frame {frame.seq}")
+            return None
+        return InferenceResult(seq=frame.seq, frame=frame, value=value)
+
+    def discard_before(self, seq: int) -> None:
+        """
+        seq以前のフレームに対する結果を今後返さないようにする
+        """
+        self._min_seq = seq
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
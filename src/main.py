@@ -1,19 +1,25 @@
 import argparse
 import logging
 import os
+import time
+from concurrent.futures import Future
 from enum import Enum, auto
 from typing import Dict, Optional
 
-import cv2
 import dotenv
 import numpy as np
 import pygame as pg
 
 import capture
-import chess
+import counter
 import db
 import face
+import inference
+import marker
+import metrics
 import pose
+import render
+import scheduler
 
 # ロガー設定
 logging.basicConfig(
@@ -30,10 +36,14 @@ class Config:
     """設定値を管理するクラス"""
 
     SCREEN_SIZE = (1920, 1080)
+    # フェーズが目標の頻度を宣言しない場合のティックの頻度
     FPS = 5
     RESULT_DURATION_MS = 10000
     RECOGNIZING_TIMEOUT_MS = 20000
-    COUNTING_TIMEOUT_MS = 2000
+    COUNTING_TIMEOUT_MS = counter.COUNTING_TIMEOUT_MS
+    # 顔認証で距離を積み上げるフレーム数と、1位と2位に求める差
+    RECOGNIZING_WINDOW = 5
+    RECOGNIZING_MARGIN = 0.08
 
     # Colors
     TEXT_COLOR = (255, 255, 255)
@@ -41,8 +51,18 @@ class Config:
     PROGRESS_BAR_COLOR = (200, 230, 210)
     FPS_COUNTER_COLOR = (255, 255, 0)
 
+    # デバッグ表示の段階ごとの処理時間を更新する間隔と、表示する段階の数
+    METRICS_REFRESH_MS = 1000
+    METRICS_LINES = 9
+
     # Pose estimation thresholds
-    CHINUP_RESET_THRESHOLD = 0.2
+    CHINUP_RESET_THRESHOLD = counter.CHINUP_RESET_THRESHOLD
+
+    # 待機中にバーの位置がずれていないか確かめる間隔と、許容するずれ(割合)
+    CALIBRATION_CHECK_INTERVAL_MS = 30000
+    CALIBRATION_DRIFT_TOLERANCE = 0.03
+    # この回数続けてずれていたら初期化し直す
+    CALIBRATION_DRIFT_COUNT = 2
 
 
 class Assets:
@@ -104,10 +124,11 @@ class State:
         self.wide: bool = False
         self.name: Optional[str] = None
         self.nickname: Optional[str] = None
+        # ニックネームを引き終わるまでは顔の名前を表示する
+        self.nickname_future: Optional[Future] = None
         self.chinuped: bool = False
         self.timers = {
             "recognizing": Config.RECOGNIZING_TIMEOUT_MS,
-            "counting": Config.COUNTING_TIMEOUT_MS,
             "result": Config.RESULT_DURATION_MS,
         }
 
@@ -127,100 +148,114 @@ class GamePhase(Enum):
 class Phase:
     """各ゲームフェーズの基底クラス"""
 
+    # 推論の目標の頻度(ティックの頻度でもある)と、推論1回にかけてよい時間
+    # STAGEは品質の段階を共有する推論の種類で、Noneのフェーズでは負荷に応じた品質の調整をしない
+    RATE: float = Config.FPS
+    LATENCY_BUDGET_MS: Optional[float] = None
+    STAGE: Optional[str] = None
+
     def __init__(self, game: "Game"):
         self.game = game
         self.state = game.state
         self.assets = game.assets
         self.screen = game.screen
+        self.renderer = game.renderer
         self.debug = game.debug
 
-        self.enter()
-
     def enter(self):
         pass
 
     def exit(self):
         pass
 
+    @property
+    def worker(self) -> Optional[inference.InferenceWorker]:
+        """
+        処理時間を予算と比べる推論
+        """
+        return None
+
     def handle_event(self, event: pg.event.Event) -> Optional["Phase"]:
         return None
 
     def update(self, dt: int) -> Optional["Phase"]:
         return self
 
+    def draw_background(self):
+        """
+        フェーズの間変わらないものを描く。フェーズに入ったときに1回だけ呼ばれる
+        """
+        pass
+
     def draw(self):
         pass
 
     def _draw_text(self, text, pos, size, color=Config.TEXT_COLOR):
-        font = self.assets.fonts.get(size)
-        if font:
-            text_surface = font.render(text, True, color)
-            self.screen.blit(text_surface, pos)
+        text_surface = self.renderer.text(text, size, color)
+        if text_surface:
+            self.renderer.blit(text_surface, pos)
 
     def _draw_image(self, image_key, **kwargs):
         image = self.assets.images[image_key]
         rect = image.get_rect(**kwargs)
-        self.screen.blit(image, rect)
+        self.renderer.blit(image, rect)
+
+    def _draw_progress(self, progress: float):
+        self.renderer.fill(
+            Config.PROGRESS_BAR_COLOR, (0, 0, Config.SCREEN_SIZE[0] * progress, 50)
+        )
 
     def _draw_camera_with_landmarks(self):
         if not self.debug:
             return
-        frame = capture.read_rgb()
+        # 推論済みのフレームと結果の組を使い、同じティックで再推論しない
+        result = self.game.detect_pose()
+        if result is not None:
+            frame, pose_result = result.frame, result.value
+        else:
+            frame, pose_result = self.game.read_frame(), None
         if frame is None:
             return
-        pose_result = pose.detect_pose(frame)
+        surface = self.game.preview.update(frame.image)
+        width, height = surface.get_size()
+
+        # プレビューは左右反転しているので、xも反転して描く
+        def to_pixel(point):
+            return (int((1 - point[0]) * width), int(point[1] * height))
 
         # ランドマークを描画
         if pose_result:
-            points_to_draw = []
-            if pose_result.nose:
-                points_to_draw.append((pose_result.nose, (0, 255, 0)))
-            if pose_result.left_hand:
-                points_to_draw.append((pose_result.left_hand, (255, 0, 0)))
-            if pose_result.right_hand:
-                points_to_draw.append((pose_result.right_hand, (0, 0, 255)))
-
-            for (x, y), color in points_to_draw:
-                center = (int(x * frame.shape[1]), int(y * frame.shape[0]))
-                cv2.circle(frame, center, 10, color, -1)
+            for point, color in (
+                (pose_result.nose, (0, 255, 0)),
+                (pose_result.left_hand, (255, 0, 0)),
+                (pose_result.right_hand, (0, 0, 255)),
+            ):
+                if point:
+                    pg.draw.circle(surface, color, to_pixel(point), 10)
 
         # chessboard_centerを描画
         if self.state.chessboard_center:
-            bar_y = int(self.state.chessboard_center[1] * frame.shape[0])
-            threshold_bar_y = int(
-                bar_y + Config.CHINUP_RESET_THRESHOLD * frame.shape[0]
-            )
-            cv2.line(frame, (0, bar_y), (frame.shape[1], bar_y), (255, 255, 0), 2)
-            cv2.line(
-                frame,
-                (0, threshold_bar_y),
-                (frame.shape[1], threshold_bar_y),
+            bar_y = int(self.state.chessboard_center[1] * height)
+            threshold_bar_y = int(bar_y + Config.CHINUP_RESET_THRESHOLD * height)
+            pg.draw.line(surface, (255, 255, 0), (0, bar_y), (width, bar_y), 2)
+            pg.draw.line(
+                surface,
                 (255, 0, 0),
+                (0, threshold_bar_y),
+                (width, threshold_bar_y),
                 2,
             )
-            cv2.circle(
-                frame,
-                (
-                    int(self.state.chessboard_center[0] * frame.shape[1]),
-                    int(self.state.chessboard_center[1] * frame.shape[0]),
-                ),
-                10,
-                (0, 255, 255),
-                -1,
+            pg.draw.circle(
+                surface, (0, 255, 255), to_pixel(self.state.chessboard_center), 10
             )
 
-        # Pygame用に変換して描画
-        frame = np.rot90(frame)
-        surface = pg.surfarray.make_surface(frame)
-        self.screen.blit(surface, (Config.SCREEN_SIZE[0] - surface.get_width(), 0))
+        self.renderer.blit(surface, (Config.SCREEN_SIZE[0] - width, 0), changed=True)
 
 
 class InitializingPhase(Phase):
     def enter(self):
-        capture.open()
-
-    def exit(self):
-        capture.release()
+        capture.activate()
+        self.calibrator = marker.Calibrator()
 
     def handle_event(self, event: pg.event.Event):
         if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
@@ -230,30 +265,43 @@ class InitializingPhase(Phase):
         return None
 
     def update(self, dt: int):
-        frame = capture.read_rgb()
+        frame = self.game.read_frame()
         if frame is None:
             logger.error("Failed to read frame from video capture")
             return self
-        center = chess.detect_chessboard_center(frame)
+        center = self.calibrator.update(frame)
         if center:
-            logger.info(f"Chessboard center detected: {center}")
+            logger.info(
+                f"Chessboard center detected: {center}"
+                f" (spread {self.calibrator.spread:.4f})"
+            )
             self.state.chessboard_center = center
+            marker.save_calibration(
+                self.game.calibration_path, center, self.game.capture_size
+            )
             self.assets.sounds["entry"].play()
             return IdlePhase(self.game)
         else:
             logger.info("Waiting for chessboard detection...")
         return self
 
-    def draw(self):
+    def draw_background(self):
         self._draw_text("初期化中...", (150, 150), 100)
         self._draw_image("wait", bottomleft=(0, Config.SCREEN_SIZE[1]))
+
+    def draw(self):
+        if self.debug and self.calibrator.spread is not None:
+            self._draw_text(f"spread: {self.calibrator.spread:.4f}", (150, 300), 50)
         self._draw_camera_with_landmarks()
 
 
 class IdlePhase(Phase):
+    # 画面はほとんど変わらないので、Enterに反応できる程度で回す
+    RATE = 2
+
     def handle_event(self, event: pg.event.Event):
         if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
-            capture.open()
+            capture.activate()
             self.assets.sounds["entry"].play()
             logger.info("Game started. -> Recognizing phase")
             return RecognizingPhase(self.game)
@@ -261,137 +309,214 @@ class IdlePhase(Phase):
 
     def enter(self):
         self.state.reset()
-        capture.release()
+        capture.standby()
+        self.check_timer = Config.CALIBRATION_CHECK_INTERVAL_MS
+        self.drift_count = 0
+        # 前に待機していた間や、再検出の前に投げたフレームの結果は使わない
+        self.game.marker_worker.discard_before(capture.last_seq())
 
-    def draw(self):
+    def update(self, dt: int):
+        capture.release_if_idle()
+        # カメラが開いていれば、ときどきバーの位置がずれていないか確かめる
+        self.check_timer -= dt
+        if self.check_timer <= 0 and capture.is_opened():
+            self.check_timer = Config.CALIBRATION_CHECK_INTERVAL_MS
+            frame = self.game.read_frame()
+            if frame is not None:
+                # 保存したバーの位置の周辺から探す
+                self.game.marker_worker.submit(frame, self.state.chessboard_center)
+
+        result = self.game.marker_worker.poll()
+        if result is None or result.value is None:
+            return self
+        drift = np.hypot(
+            result.value[0] - self.state.chessboard_center[0],
+            result.value[1] - self.state.chessboard_center[1],
+        )
+        if drift <= Config.CALIBRATION_DRIFT_TOLERANCE:
+            self.drift_count = 0
+            return self
+        self.drift_count += 1
+        logger.info(f"Chessboard drifted by {drift:.3f}")
+        if self.drift_count >= Config.CALIBRATION_DRIFT_COUNT:
+            logger.info("Recalibrating. -> Initializing phase")
+            return InitializingPhase(self.game)
+        return self
+
+    def draw_background(self):
         self._draw_text("待機中...", (150, 150), 100)
         self._draw_text("Enterでスタート！！", (150, 400), 100)
         self._draw_image("wait", bottomleft=(0, Config.SCREEN_SIZE[1]))
 
 
 class RecognizingPhase(Phase):
+    LATENCY_BUDGET_MS = 400
+    STAGE = "face"
+
+    @property
+    def worker(self):
+        return self.game.face_worker
+
+    def enter(self):
+        self.game.face_worker.discard_before(capture.last_seq())
+        # 前のセッションで特徴量を計算し終えた顔を引き継ぐと、投票に使う距離が出てこない
+        self.game.face_worker.reconfigure(face.reset_tracking)
+        self.voter = face.IdentityVoter(
+            window=Config.RECOGNIZING_WINDOW,
+            margin=Config.RECOGNIZING_MARGIN,
+        )
+
     def update(self, dt: int):
         self.state.timers["recognizing"] -= dt
         if self.state.timers["recognizing"] <= 0:
             logger.info("Recognition failed, returning to idle.")
             return IdlePhase(self.game)
 
-        frame = capture.read_rgb()
+        frame = self.game.read_frame()
         if frame is None:
             logger.error("Failed to read frame from video capture")
             return self
+        # 露出が落ち着く前のフレームでは認識しない
+        if not capture.is_ready():
+            return self
 
-        names = face.recognize_face_names(frame)
-        if len(names) == 1:
-            self.state.name = names[0]
+        self.game.face_worker.submit(frame)
+        result = self.game.face_worker.poll()
+        if result is None:
+            return self
+
+        observations = result.value
+        if len(observations) > 1:
+            logger.debug(f"Multiple faces detected: {len(observations)}")
+        name = self.voter.add(observations)
+        if name is not None:
+            self.state.name = name
             logger.info(f"Recognized: {self.state.name}")
-            self.state.nickname = db.get_nickname(self.state.name)
+            self.state.nickname = self.state.name
+            self.state.nickname_future = db.get_nickname_async(self.state.name)
             self.assets.sounds["entry"].play()
             return WaitingHandsPhase(self.game)
-        elif len(names) > 1:
-            logger.warning(f"Multiple faces recognized: {names}")
 
         return self
 
-    def draw(self):
+    def draw_background(self):
         self._draw_text("顔認証中...", (150, 150), 100)
         self._draw_image("setup", bottomleft=(0, Config.SCREEN_SIZE[1]))
-        progress = self.state.timers["recognizing"] / Config.RECOGNIZING_TIMEOUT_MS
-        pg.draw.rect(
-            self.screen,
-            Config.PROGRESS_BAR_COLOR,
-            (0, 0, Config.SCREEN_SIZE[0] * progress, 50),
+
+    def draw(self):
+        self._draw_progress(
+            self.state.timers["recognizing"] / Config.RECOGNIZING_TIMEOUT_MS
         )
+        if self.debug:
+            # 顔ごとの暫定スコアを近い順に表示
+            y = 300
+            for track_id, scores in self.voter.all_scores().items():
+                ranking = sorted(scores.items(), key=lambda x: x[1])[:3]
+                text = " ".join(f"{name}:{score:.2f}" for name, score in ranking)
+                self._draw_text(f"#{track_id} {text}", (1000, y), 50)
+                y += 60
 
 
 class WaitingHandsPhase(Phase):
+    RATE = 10
+    LATENCY_BUDGET_MS = 100
+    STAGE = "pose"
+
+    @property
+    def worker(self):
+        return self.game.pose_worker
+
+    def enter(self):
+        self.last_seq = capture.last_seq()
+
     def update(self, dt: int):
-        frame = capture.read_rgb()
-        if frame is None:
+        if self.game.read_frame() is None:
             logger.error("Failed to read frame from video capture")
             return self  # or IdlePhase
 
-        pose_result = pose.detect_pose(frame)
-        if pose_result and pose_result.left_hand and pose_result.right_hand:
-            if (
-                pose_result.left_hand[1] <= self.state.chessboard_center[1]
-                and pose_result.right_hand[1] <= self.state.chessboard_center[1]
-            ):
-                self.state.wide = (
-                    pose_result.left_hand[0] > self.state.chessboard_center[0]
-                )
-                logger.info("Hands detected, starting count.")
-                self.assets.sounds["entry"].play()
-                return CountingPhase(self.game)
+        result = self.game.detect_pose()
+        if result is None or result.seq <= self.last_seq:
+            return self
+        self.last_seq = result.seq
+
+        pose_result = result.value
+        if counter.hands_on_bar(pose_result, self.state.chessboard_center):
+            self.state.wide = counter.is_wide(pose_result, self.state.chessboard_center)
+            logger.info("Hands detected, starting count.")
+            self.assets.sounds["entry"].play()
+            return CountingPhase(self.game)
         return self
 
-    def draw(self):
+    def draw_background(self):
         self._draw_text(self.state.nickname, (150, 150), 100)
         self._draw_text("バーを持ってね〜！", (150, 400), 100)
         self._draw_image("guide", bottomright=Config.SCREEN_SIZE)
+
+    def draw(self):
         self._draw_camera_with_landmarks()
 
 
 class CountingPhase(Phase):
+    # 速い1回を取りこぼさないように、推論が間に合う限り頻度を上げる
+    RATE = 15
+    LATENCY_BUDGET_MS = 66
+    STAGE = "pose"
+
+    @property
+    def worker(self):
+        return self.game.pose_worker
+
+    def enter(self):
+        self.last_seq = capture.last_seq()
+        self.counter = counter.create(
+            self.game.rep_detector,
+            self.state.chessboard_center,
+            Config.CHINUP_RESET_THRESHOLD,
+            Config.COUNTING_TIMEOUT_MS,
+        )
+
     def update(self, dt: int):
-        frame = capture.read_rgb()
-        if frame is None:
+        if self.game.read_frame() is None:
             logger.error("Failed to read frame from video capture")
             return ResultPhase(self.game)
 
-        pose_result = pose.detect_pose(frame)
-
-        if (
-            not (
-                pose_result
-                and pose_result.nose
-                and pose_result.left_hand
-                and pose_result.right_hand
-            )
-            or pose_result.left_hand[1]
-            > self.state.chessboard_center[1] + Config.CHINUP_RESET_THRESHOLD
-            or pose_result.right_hand[1]
-            > self.state.chessboard_center[1] + Config.CHINUP_RESET_THRESHOLD
-        ):
-            self.state.timers["counting"] -= dt
-            if self.state.timers["counting"] <= 0:
+        result = self.game.detect_pose()
+        if result is None or result.seq <= self.last_seq:
+            # 推論が止まったり遅れたりして結果が届かなくても終わるように、
+            # 撮影時刻と同じ時計で経過時間を測る
+            if self.counter.expire(time.monotonic() * 1000):
                 return ResultPhase(self.game)
-        else:
-            self.state.reset_timer("counting")
-            # 顔がバーを越えたらカウント
-            if (
-                pose_result.nose[1] <= self.state.chessboard_center[1]
-                and not self.state.chinuped
-            ):
-                self.state.chinuped = True
-                self.state.count += 1
-                self.assets.sounds["count"].play()
-                logger.info(f"Count incremented: {self.state.count}")
-            # 顔が一定以上下がったらリセット
-            if (
-                pose_result.nose[1]
-                > self.state.chessboard_center[1] + Config.CHINUP_RESET_THRESHOLD
-            ):
-                self.state.chinuped = False
+            return self
+        self.last_seq = result.seq
+
+        # 結果は毎ティック届くとは限らないので撮影時刻で経過時間を測る
+        if self.counter.update(result.value, result.frame.timestamp * 1000):
+            self.state.count = self.counter.count
+            self.assets.sounds["count"].play()
+            logger.info(f"Count incremented: {self.state.count}")
+        self.state.chinuped = self.counter.chinuped
+        if self.counter.finished:
+            return ResultPhase(self.game)
         return self
 
-    def draw(self):
+    def draw_background(self):
         self._draw_text("カウント中...", (150, 150), 100)
         self._draw_text(f"{self.state.nickname}さん", (150, 400), 150)
-        self._draw_text(f"{self.state.count}回！", (150, 600), 200)
         self._draw_text(
             "wide" if self.state.wide else "narrow",
             (1000, 150),
             100,
             color=(0, 255, 0) if self.state.wide else (255, 0, 0),
         )
+
+    def draw(self):
+        self._draw_text(f"{self.state.count}回！", (150, 600), 200)
         self._draw_image(
             "arrowdown" if self.state.chinuped else "arrowup",
             topright=(Config.SCREEN_SIZE[0] - 150, 100),
         )
         image = self.assets.get_rank_image(self.state.count)
-        rect = image.get_rect(bottomright=Config.SCREEN_SIZE)
-        self.screen.blit(image, rect)
+        self.renderer.blit(image, image.get_rect(bottomright=Config.SCREEN_SIZE))
         self._draw_camera_with_landmarks()
 
 
@@ -400,8 +525,8 @@ class ResultPhase(Phase):
         super().__init__(game)
 
     def enter(self):
-        db.register_record(self.state.name, self.state.count, self.state.wide)
-        capture.release()
+        db.enqueue_record(self.state.name, self.state.count, self.state.wide)
+        capture.standby()
 
     def handle_event(self, event: pg.event.Event):
         if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
@@ -416,19 +541,15 @@ class ResultPhase(Phase):
             return IdlePhase(self.game)
         return self
 
-    def draw(self):
+    def draw_background(self):
         self._draw_text("結果", (150, 150), 100)
         self._draw_text(f"{self.state.nickname}さん", (150, 400), 150)
         self._draw_text(f"{self.state.count}回！", (150, 600), 200)
         image = self.assets.get_rank_image(self.state.count)
-        rect = image.get_rect(bottomright=Config.SCREEN_SIZE)
-        self.screen.blit(image, rect)
-        progress = self.state.timers["result"] / Config.RESULT_DURATION_MS
-        pg.draw.rect(
-            self.screen,
-            Config.PROGRESS_BAR_COLOR,
-            (0, 0, Config.SCREEN_SIZE[0] * progress, 50),
-        )
+        self.renderer.blit(image, image.get_rect(bottomright=Config.SCREEN_SIZE))
+
+    def draw(self):
+        self._draw_progress(self.state.timers["result"] / Config.RESULT_DURATION_MS)
 
 
 class Game:
@@ -438,9 +559,36 @@ class Game:
         pg.init()
 
         # 外部モジュールの初期化
-        face.init(args.face_feature)
-        pose.init(args.pose_model_complexity)
-        capture.init(args.capture_width, args.capture_height)
+        # processの場合、顔認識と姿勢推定のモデルは子プロセス側で初期化する
+        if args.inference_executor == "thread":
+            face.init(args.face_feature, args.face_index, args.face_watch_interval)
+            pose.init(args.pose_model_complexity, args.pose_mode)
+        self.face_worker = self._create_worker(
+            face.recognize_faces,
+            face.init,
+            (args.face_feature, args.face_index, args.face_watch_interval),
+            args,
+        )
+        self.pose_worker = self._create_worker(
+            pose.detect_pose,
+            pose.init,
+            (args.pose_model_complexity, args.pose_mode),
+            args,
+        )
+        # バーの位置の検出は軽いので常にスレッドで行う
+        marker.init(args.marker)
+        self.marker_worker = inference.InferenceWorker(
+            marker.detect_marker_center, "thread"
+        )
+        db.init_outbox(args.outbox)
+        db.preload_members()
+        capture.init(
+            args.capture_width,
+            args.capture_height,
+            args.threaded_capture,
+            args.idle_policy,
+            args.idle_release_minutes,
+        )
 
         # ゲームの初期設定
         self.screen = pg.display.set_mode(
@@ -450,52 +598,201 @@ class Game:
         pg.display.set_caption("kensuiou")
         self.clock = pg.time.Clock()
         self.assets = Assets()
+        self.renderer = render.Renderer(
+            self.screen, self.assets.fonts, Config.BACKGROUND_COLOR
+        )
+        self.preview = render.CameraPreview()
         self.state = State()
         self.debug = args.debug
-        self.current_phase: Phase = InitializingPhase(self)
+        if self.debug:
+            metrics.enable()
+        self._metrics_lines: list[str] = []
+        self._metrics_timer = 0
+        self.rep_detector = args.rep_detector
+
+        # 1ティック内で共有するフレームと姿勢推定結果
+        self.tick = 0
+        self._frame: Optional[capture.FrameContext] = None
+        self._frame_tick = -1
+        self._pose: Optional[inference.InferenceResult] = None
+        self._pose_tick = -1
+
+        # 前回検出したバーの位置が残っていれば初期化を飛ばす
+        self.calibration_path = args.calibration
+        self.capture_size = (args.capture_width, args.capture_height)
+        # 推論が予算に収まらなければ解像度、モデル、頻度の順に落とす
+        # 解像度を落とすと顔が小さくなって認識できないので、顔認識では頻度だけを落とす
+        self.scheduler = scheduler.Scheduler(
+            {
+                "face": scheduler.quality_levels(
+                    self.capture_size, args.pose_model_complexity, ("rate_scale",)
+                ),
+                "pose": scheduler.quality_levels(
+                    self.capture_size, args.pose_model_complexity
+                ),
+            },
+            self._apply_quality,
+            args.load_shedding,
+        )
+        self.state.chessboard_center = marker.load_calibration(
+            self.calibration_path, self.capture_size
+        )
+        if self.state.chessboard_center:
+            logger.info(f"Using saved calibration: {self.state.chessboard_center}")
+            # 待機中の確認と最初のセッションのためにカメラを温めておく
+            capture.activate()
+            self.current_phase: Phase = IdlePhase(self)
+        else:
+            self.current_phase = InitializingPhase(self)
+        self.current_phase.enter()
+        self._enter_schedule()
+        self.renderer.compose(self.current_phase.draw_background)
 
     def run(self):
         running = True
         while running:
-            dt = self.clock.tick(Config.FPS)
+            dt = self.clock.tick(self.scheduler.tick_rate)
+            self.tick += 1
 
             for event in pg.event.get():
                 if event.type == pg.QUIT or (
                     event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE
                 ):
                     running = False
+                if event.type in (pg.VIDEORESIZE, pg.VIDEOEXPOSE):
+                    self.renderer.invalidate()
 
                 next_phase = self.current_phase.handle_event(event)
                 if next_phase:
                     self._change_phase(next_phase)
 
-            next_phase = self.current_phase.update(dt)
+            with metrics.span("update"):
+                next_phase = self.current_phase.update(dt)
+            self.scheduler.update(self.current_phase.worker, dt)
             if next_phase is not self.current_phase:
                 self._change_phase(next_phase)
+            self._update_nickname()
 
-            self.screen.fill(Config.BACKGROUND_COLOR)
-            self.current_phase.draw()
-            if self.debug:
-                self._draw_fps()
-            pg.display.flip()
+            # 背景は変わらないので、毎ティック描くのは変わりうる部分だけ
+            with metrics.span("draw"):
+                self.current_phase.draw()
+                if self.debug:
+                    self._draw_fps()
+                    self._draw_metrics(dt)
+            with metrics.span("present"):
+                self.renderer.present()
 
         self._cleanup()
 
+    def read_frame(self) -> Optional[capture.FrameContext]:
+        """
+        このティックのフレームを返す
+        カメラからの読み込みは1ティックに1回だけ行う
+        """
+        if self._frame_tick != self.tick:
+            self._frame = capture.read_frame()
+            self._frame_tick = self.tick
+        return self._frame
+
+    def detect_pose(self) -> Optional[inference.InferenceResult]:
+        """
+        このティックのフレームを姿勢推定に投げ、完了済みの最新の結果を返す
+        結果には推論に使ったフレームが含まれる
+        """
+        if self._pose_tick != self.tick:
+            self._pose_tick = self.tick
+            # 先に完了した結果を受け取ってから、空いたワーカーにこのティックのフレームを投げる
+            result = self.pose_worker.poll()
+            if result is not None:
+                self._pose = result
+            frame = self.read_frame()
+            if frame is not None:
+                self.pose_worker.submit(frame, self.state.chessboard_center)
+        return self._pose
+
+    @staticmethod
+    def _create_worker(fn, initializer, initargs, args) -> inference.InferenceWorker:
+        if args.inference_executor == "thread":
+            return inference.InferenceWorker(fn, "thread")
+        return inference.InferenceWorker(fn, "process", initializer, initargs)
+
     def _change_phase(self, new_phase: Phase):
         if new_phase and new_phase is not self.current_phase:
             self.current_phase.exit()
             self.current_phase = new_phase
             self.current_phase.enter()
+            self._enter_schedule()
+            self.renderer.compose(self.current_phase.draw_background)
+
+    def _update_nickname(self):
+        """
+        裏で引いていたニックネームが届いたら、表示している名前を差し替える
+        """
+        future = self.state.nickname_future
+        if future is None or not future.done():
+            return
+        self.state.nickname_future = None
+        if future.exception() is not None:
+            logger.warning(f"Failed to look up nickname: {future.exception()!r}")
+            return
+        nickname = future.result()
+        if nickname != self.state.nickname:
+            self.state.nickname = nickname
+            # ニックネームは背景に描いているので描き直す
+            self.renderer.compose(self.current_phase.draw_background)
+
+    def _enter_schedule(self):
+        self.scheduler.set_phase(
+            self.current_phase.RATE,
+            self.current_phase.LATENCY_BUDGET_MS,
+            self.current_phase.STAGE,
+        )
+
+    def _apply_quality(
+        self, previous: scheduler.Quality, quality: scheduler.Quality
+    ) -> None:
+        if quality.capture_size != previous.capture_size:
+            capture.set_resolution(*quality.capture_size)
+        if quality.pose_model_complexity != previous.pose_model_complexity:
+            self.pose_worker.reconfigure(
+                pose.set_model_complexity, quality.pose_model_complexity
+            )
 
     def _draw_fps(self):
-        font = self.assets.fonts[50]
-        fps_text = f"FPS: {int(self.clock.get_fps())}"
-        text_surface = font.render(fps_text, True, Config.FPS_COUNTER_COLOR)
-        self.screen.blit(text_surface, (10, 10))
+        fps_text = (
+            f"FPS: {int(self.clock.get_fps())}/{self.scheduler.tick_rate:g}"
+            f" Q{self.scheduler.level}"
+        )
+        text_surface = self.renderer.text(fps_text, 50, Config.FPS_COUNTER_COLOR)
+        self.renderer.blit(text_surface, (10, 10))
+
+    def _draw_metrics(self, dt: int):
+        # 毎ティック文字を作り直さないように、表示する値はときどきだけ更新する
+        self._metrics_timer -= dt
+        if self._metrics_timer <= 0:
+            self._metrics_timer = Config.METRICS_REFRESH_MS
+            # 遅い段階から順に表示する
+            stages = sorted(
+                metrics.snapshot().items(),
+                key=lambda item: item[1]["p95_ms"],
+                reverse=True,
+            )
+            self._metrics_lines = [
+                f"{name} {stage['p50_ms']:.0f}/{stage['p95_ms']:.0f}ms"
+                for name, stage in stages[: Config.METRICS_LINES]
+            ]
+        for i, line in enumerate(self._metrics_lines):
+            text_surface = self.renderer.text(line, 50, Config.FPS_COUNTER_COLOR)
+            self.renderer.blit(text_surface, (760, 500 + i * 60))
 
     def _cleanup(self):
         logger.info("Exiting game loop, releasing resources.")
         capture.release()
+        self.face_worker.shutdown()
+        self.pose_worker.shutdown()
+        self.marker_worker.shutdown()
+        db.close()
+        metrics.stop()
         pg.quit()
 
 
@@ -504,16 +801,60 @@ def main():
     parser.add_argument(
         "--face-feature", type=str, default="assets/models/face_features.json"
     )
+    parser.add_argument(
+        "--face-index", choices=face.INDEX_TYPES, type=str, default="flat"
+    )
+    parser.add_argument("--face-watch-interval", type=float, default=10.0)
     parser.add_argument(
         "--pose-model-complexity", choices=[0, 1, 2], type=int, default=0
     )
+    parser.add_argument("--pose-mode", choices=pose.MODES, type=str, default="static")
     parser.add_argument("--capture-width", type=int, default=640)
     parser.add_argument("--capture-height", type=int, default=480)
+    parser.add_argument("--threaded-capture", action="store_true")
+    parser.add_argument(
+        "--idle-policy", choices=capture.IDLE_POLICIES, type=str, default="keep"
+    )
+    parser.add_argument("--idle-release-minutes", type=float, default=10.0)
+    parser.add_argument(
+        "--inference-executor",
+        choices=inference.EXECUTORS,
+        type=str,
+        default="thread",
+    )
+    parser.add_argument("--outbox", type=str, default="outbox.sqlite3")
+    parser.add_argument("--calibration", type=str, default="calibration.json")
+    parser.add_argument(
+        "--marker", choices=marker.MARKER_TYPES, type=str, default="chessboard"
+    )
+    parser.add_argument(
+        "--rep-detector",
+        choices=counter.DETECTORS,
+        type=str,
+        default="threshold",
+        help="landmarks are smoothed only with peak; threshold uses raw landmarks",
+    )
+    parser.add_argument(
+        "--load-shedding", action=argparse.BooleanOptionalAction, default=True
+    )
     parser.add_argument("--resizable", action="store_true")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--metrics-output", type=str, default=None)
+    parser.add_argument(
+        "--metrics-format", choices=metrics.FORMATS, type=str, default="json"
+    )
+    parser.add_argument("--metrics-interval", type=float, default=10.0)
+    parser.add_argument("--profile", type=str, default=None)
 
     args = parser.parse_args()
 
+    if args.metrics_output:
+        metrics.start_dump(
+            args.metrics_output, args.metrics_interval, args.metrics_format
+        )
+    if args.profile:
+        metrics.start_profile(args.profile)
+
     game = Game(args)
     game.run()
 
@@ -0,0 +1,208 @@
+"""
+バーの位置を示すマーカーの検出
+
+チェスボード、QRコード、ArUcoのどれを使っても同じ関数で中心を得られる
+グレースケールへの変換はフレームごとに1回だけ行い、呼び出し側が渡した前回の位置の周辺から先に探す
+前回の位置は呼び出し側ごとに持つので、スレッドをまたいで状態を共有しない
+"""
+
+import json
+import logging
+import os
+from collections import deque
+
+import cv2
+import numpy as np
+
+import capture
+import chess
+import metrics
+import qr
+
+logger = logging.getLogger(__name__)
+
+MARKER_TYPES = ("chessboard", "qr", "aruco")
+ARUCO_DICTIONARY = cv2.aruco.DICT_4X4_50
+
+# 前回の位置から上下左右にこの割合の範囲を先に探す
+SEARCH_RADIUS = 0.15
+
+# 中心を平均するフレーム数と、確定に求めるばらつき(割合)
+CALIBRATION_FRAMES = 5
+CALIBRATION_MAX_SPREAD = 0.005
+# 中央値からこの割合以上離れた中心は外れ値として捨てる
+CALIBRATION_OUTLIER_DISTANCE = 0.02
+
+
+def _find_aruco_center(gray: cv2.Mat) -> tuple[float, float] | None:
+    corners, ids, _ = _aruco_detector.detectMarkers(gray)
+    if ids is None or len(corners) == 0:
+        logger.debug("failed to detect ArUco marker")
+        return None
+    center = corners[0].reshape(-1, 2).mean(axis=0)
+    return (float(center[0]), float(center[1]))
+
+
+def _detect_aruco_center(frame: capture.FrameContext) -> tuple[float, float] | None:
+    return _find_aruco_center(frame.gray())
+
+
+_aruco_detector = None
+# 切り出したグレースケール画像から探す関数と、フレーム全体から探す関数
+_finder = chess.find_chessboard_center
+_detector = chess.detect_chessboard_center
+_marker_type = "chessboard"
+
+
+def init(marker_type: str = "chessboard") -> None:
+    global _finder, _detector, _marker_type, _aruco_detector
+    if marker_type == "chessboard":
+        _finder = chess.find_chessboard_center
+        _detector = chess.detect_chessboard_center
+    elif marker_type == "qr":
+        qr.init()
+        _finder = qr.find_qr_code_center
+        _detector = qr.detect_qr_code_center
+    elif marker_type == "aruco":
+        _aruco_detector = cv2.aruco.ArucoDetector(
+            cv2.aruco.getPredefinedDictionary(ARUCO_DICTIONARY)
+        )
+        _finder = _find_aruco_center
+        _detector = _detect_aruco_center
+    else:
+        raise ValueError(f"Unknown marker type: {marker_type}")
+    _marker_type = marker_type
+
+
+@metrics.timed("marker")
+def detect_marker_center(
+    frame: capture.FrameContext, near: tuple[float, float] | None = None
+) -> tuple[float, float] | None:
+    """
+    frameに含まれるマーカーの中心座標を割合で返す
+    nearに前回の位置を渡すと、その周辺を先に探す
+    """
+    gray = frame.gray()
+    height, width = gray.shape
+
+    if near is not None:
+        x0 = max(int((near[0] - SEARCH_RADIUS) * width), 0)
+        x1 = min(int((near[0] + SEARCH_RADIUS) * width), width)
+        y0 = max(int((near[1] - SEARCH_RADIUS) * height), 0)
+        y1 = min(int((near[1] + SEARCH_RADIUS) * height), height)
+        point = _finder(gray[y0:y1, x0:x1])
+        if point is not None:
+            return normalize_center((point[0] + x0, point[1] + y0), gray.shape)
+        logger.debug("Marker not found near last position, searching full frame")
+
+    point = _detector(frame)
+    if point is None:
+        return None
+    return normalize_center(point, gray.shape)
+
+
+def normalize_center(
+    point: tuple[float, float], shape: tuple[int, ...]
+) -> tuple[float, float]:
+    """
+    ピクセル座標を画像の大きさに対する割合に直す
+    """
+    height, width = shape[:2]
+    return (point[0] / width, point[1] / height)
+
+
+class Calibrator:
+    """
+    直近のフレームで検出した中心を外れ値を除いて平均し、ばらつきが十分小さくなったら確定する
+    """
+
+    def __init__(
+        self,
+        frames: int = CALIBRATION_FRAMES,
+        max_spread: float = CALIBRATION_MAX_SPREAD,
+    ):
+        self.frames = frames
+        self.max_spread = max_spread
+        self._centers: deque[tuple[float, float]] = deque(maxlen=frames)
+        # 次のフレームで先に探す位置
+        self._last_center: tuple[float, float] | None = None
+        self.center: tuple[float, float] | None = None
+        # 平均に使った中心の標準偏差(割合)。小さいほど安定している
+        self.spread: float | None = None
+
+    def update(self, frame: capture.FrameContext) -> tuple[float, float] | None:
+        """
+        frameを加え、中心が確定すればそれを返す
+        """
+        center = detect_marker_center(frame, self._last_center)
+        if center is None:
+            return None
+        self._last_center = center
+        return self.add(center)
+
+    def add(self, center: tuple[float, float]) -> tuple[float, float] | None:
+        self._centers.append(center)
+        centers = np.asarray(self._centers)
+        median = np.median(centers, axis=0)
+        inliers = centers[
+            np.linalg.norm(centers - median, axis=1) <= CALIBRATION_OUTLIER_DISTANCE
+        ]
+        if len(inliers) == 0:
+            return None
+        self.center = tuple(float(v) for v in inliers.mean(axis=0))
+        self.spread = float(np.linalg.norm(inliers.std(axis=0)))
+        if len(inliers) >= self.frames * 0.8 and self.spread <= self.max_spread:
+            return self.center
+        return None
+
+
+def save_calibration(
+    path: str, center: tuple[float, float], resolution: tuple[int, int]
+) -> None:
+    """
+    検出した中心をマーカーの種類、カメラの解像度とともに保存する
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "center": list(center),
+                "resolution": list(resolution),
+                "marker": _marker_type,
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+    logger.info(f"Saved calibration to {path}")
+
+
+def load_calibration(
+    path: str, resolution: tuple[int, int]
+) -> tuple[float, float] | None:
+    """
+    保存した中心を返す。ファイルが無いか壊れている場合、解像度かマーカーの種類が違う場合はNone
+    """
+    try:
+        with open(path, "r") as f:
+            calibration = json.load(f)
+    except OSError:
+        return None
+    except ValueError:
+        logger.warning(f"Ignoring malformed calibration {path}")
+        return None
+    try:
+        saved_resolution = calibration.get("resolution")
+        marker_type = calibration.get("marker", "chessboard")
+        x, y = (float(v) for v in calibration["center"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logger.warning(f"Ignoring malformed calibration {path}")
+        return None
+    if not isinstance(saved_resolution, list) or tuple(saved_resolution) != tuple(
+        resolution
+    ):
+        logger.info(f"Ignoring calibration for resolution {saved_resolution}")
+        return None
+    if marker_type != _marker_type:
+        logger.info(f"Ignoring calibration for marker {marker_type}")
+        return None
+    return (x, y)
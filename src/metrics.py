@@ -0,0 +1,226 @@
+"""
+処理時間の計測
+
+span()やtimed()で囲んだ区間の時間を段階ごとに直近WINDOW回分だけ保持し、分位点を求める
+結果はデバッグ表示、JSONかPrometheusのテキスト形式のファイル、cProfileの結果として取り出せる
+無効なときは何もしないオブジェクトを返すだけなので、計測を埋め込んだままでも負荷はほとんどない
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 段階ごとに保持する直近の計測数
+WINDOW = 256
+FORMATS = ("json", "prometheus")
+PROMETHEUS_METRIC = "kensuiou_stage_duration_ms"
+QUANTILES = (0.5, 0.95, 0.99)
+
+_enabled = False
+_window: int | None = WINDOW
+_lock = threading.Lock()
+_samples: dict[str, deque[float]] = {}
+_counts: dict[str, int] = {}
+_sums: dict[str, float] = {}
+_dump_thread: threading.Thread | None = None
+_dump_args: tuple[str, str] | None = None
+_dump_stop = threading.Event()
+_profiler: cProfile.Profile | None = None
+_profile_path: str | None = None
+
+
+def enable(window: int | None = WINDOW) -> None:
+    """
+    windowは段階ごとに保持する計測数。Noneなら全部を保持する
+    """
+    global _enabled, _window
+    _enabled = True
+    _window = window
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+def span(name: str):
+    """
+    withで囲んだ区間の時間をnameの段階として記録する
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name: str):
+    """
+    関数の実行時間をnameの段階として記録するデコレーター
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, (time.perf_counter() - start) * 1000)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name: str, elapsed_ms: float) -> None:
+    if not _enabled:
+        return
+    samples = _samples.get(name)
+    if samples is None:
+        with _lock:
+            samples = _samples.setdefault(name, deque(maxlen=_window))
+    # dequeへの追加はスレッドをまたいでも安全
+    samples.append(elapsed_ms)
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + 1
+        _sums[name] = _sums.get(name, 0.0) + elapsed_ms
+
+
+def snapshot() -> dict[str, dict[str, float]]:
+    """
+    段階ごとの直近の分位点と、起動してからの回数・合計時間
+    """
+    with _lock:
+        stages = {name: list(samples) for name, samples in _samples.items()}
+        counts = dict(_counts)
+        sums = dict(_sums)
+    result = {}
+    for name, samples in sorted(stages.items()):
+        if not samples:
+            continue
+        quantiles = np.quantile(samples, QUANTILES)
+        result[name] = {
+            "count": counts[name],
+            "sum_ms": round(sums[name], 3),
+            **{
+                f"p{round(q * 100)}_ms": round(float(v), 3)
+                for q, v in zip(QUANTILES, quantiles)
+            },
+        }
+    return result
+
+
+def to_json() -> str:
+    return json.dumps({"timestamp": time.time(), "stages": snapshot()}, indent=2)
+
+
+def to_prometheus() -> str:
+    lines = [f"# TYPE {PROMETHEUS_METRIC} summary"]
+    for name, stage in snapshot().items():
+        label = f'stage="{name}"'
+        for q in QUANTILES:
+            value = stage[f"p{round(q * 100)}_ms"]
+            lines.append(f'{PROMETHEUS_METRIC}{{{label},quantile="{q}"}} {value}')
+        lines.append(f"{PROMETHEUS_METRIC}_sum{{{label}}} {stage['sum_ms']}")
+        lines.append(f"{PROMETHEUS_METRIC}_count{{{label}}} {stage['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(path: str, output_format: str = "json") -> None:
+    """
+    現在の値をpathに書き出す。読む側が書きかけのファイルを見ないように置き換える
+    """
+    text = to_prometheus() if output_format == "prometheus" else to_json()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def start_dump(path: str, interval: float, output_format: str = "json") -> None:
+    """
+    interval秒ごとにpathへ書き出すスレッドを起動する
+    """
+    global _dump_thread, _dump_args
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown metrics format: {output_format}")
+    enable()
+    _dump_args = (path, output_format)
+    _dump_stop.clear()
+
+    def loop():
+        while not _dump_stop.wait(interval):
+            _safe_dump(path, output_format)
+
+    _dump_thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    _dump_thread.start()
+
+
+def _safe_dump(path: str, output_format: str) -> None:
+    try:
+        dump(path, output_format)
+    except OSError as e:
+        logger.warning(f"Failed to dump metrics to {path}: {e}")
+
+
+def start_profile(path: str) -> None:
+    """
+    呼び出したスレッドをcProfileで計測し、stop()でpathに書き出す
+    推論スレッドまで含めて見たい場合はpy-spy record --subprocessesを使う
+    """
+    global _profiler, _profile_path
+    _profiler = cProfile.Profile()
+    _profile_path = path
+    _profiler.enable()
+
+
+def stop() -> None:
+    """
+    定期的な書き出しとプロファイルを止め、最後の値を書き出す
+    """
+    global _dump_thread, _profiler
+    if _dump_thread is not None:
+        _dump_stop.set()
+        _dump_thread.join()
+        _dump_thread = None
+        _safe_dump(*_dump_args)
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        logger.info(f"Saved profile to {_profile_path}")
+        _profiler = None
@@ -12,8 +12,12 @@ import time
 from dataclasses import dataclass
 
 import cv2
+import numpy as np
 from mediapipe.python.solutions import pose as mp_pose
 
+import capture
+import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,16 +28,168 @@ class PoseDetectionResult:
     right_hand: tuple[float, float] | None
 
 
-pose = None
+MODES = ("static", "tracking")
 
+# trackingモードで切り出す領域の大きさ(フレームに対する割合)
+ROI_WIDTH = 0.6
+ROI_HEIGHT = 0.9
+# 切り出す領域の上端をバーからどれだけ上に取るか
+ROI_TOP_MARGIN = 0.15
+# ランドマークが領域の端からこの割合以内に来たら領域を取り直す
+ROI_EDGE_MARGIN = 0.05
 
-def init(model_complexity: int = 0) -> None:
-    global pose
+pose = None
+tracker = None
+_mode = "static"
+_model_complexity = 0
+_roi: tuple[int, int, int, int] | None = None
+# _roiを決めたときのフレームの(高さ, 幅)
+_roi_shape: tuple[int, int] | None = None
+_last_result: PoseDetectionResult | None = None
+# 切り出した領域を写すバッファ
+_crop: np.ndarray | None = None
+
+
+def init(model_complexity: int = 0, mode: str = "static") -> None:
+    """
+    trackingモードではバー周辺を切り出した領域をMediaPipeの動画モードで追跡し、
+    見失ったときだけフレーム全体から人物を検出し直す
+    """
+    global pose, tracker, _mode, _model_complexity
+    if mode not in MODES:
+        raise ValueError(f"Unknown pose mode: {mode}")
     pose = mp_pose.Pose(static_image_mode=True, model_complexity=model_complexity)
-
-
-def detect_pose(frame: cv2.Mat) -> PoseDetectionResult:
-    results = pose.process(frame)
+    if mode == "tracking":
+        tracker = mp_pose.Pose(
+            static_image_mode=False, model_complexity=model_complexity
+        )
+    _mode = mode
+    _model_complexity = model_complexity
+
+
+def reset_tracking() -> None:
+    """
+    別の人や動画を扱う前に呼び、切り出す領域と動画モードの追跡を初めからやり直す
+    推論と同じワーカーから呼ぶ
+    """
+    global tracker, _roi, _roi_shape, _last_result
+    if tracker is not None:
+        tracker.close()
+        tracker = mp_pose.Pose(
+            static_image_mode=False, model_complexity=_model_complexity
+        )
+    _roi = None
+    _roi_shape = None
+    _last_result = None
+
+
+def set_model_complexity(model_complexity: int) -> None:
+    """
+    モデルを作り直す。推論と同時に呼ばないように、推論と同じワーカーから呼ぶ
+    """
+    global _roi
+    for model in (pose, tracker):
+        if model is not None:
+            model.close()
+    init(model_complexity, _mode)
+    _roi = None
+
+
+@metrics.timed("pose")
+def detect_pose(
+    frame: capture.FrameContext, roi_anchor: tuple[float, float] | None = None
+) -> PoseDetectionResult:
+    """
+    roi_anchorはバーの位置(割合)で、trackingモードの切り出しの基準になる
+    """
+    global _roi, _roi_shape, _last_result
+    image = frame.rgb()
+    if _mode == "tracking" and roi_anchor is not None:
+        # 領域はピクセルで持つので、解像度が変わったら取り直す
+        if _roi is None or _roi_shape != image.shape[:2]:
+            _roi = _compute_roi(image.shape, roi_anchor, _last_result)
+            _roi_shape = image.shape[:2]
+        result = _track(image, _roi)
+        if result is not None:
+            _last_result = result
+            return result
+        logger.debug("Pose tracking lost, falling back to full-frame detection")
+        _roi = None
+
+    result = _extract(pose.process(image))
+    _last_result = result
+    return result
+
+
+def _compute_roi(
+    shape: tuple[int, ...],
+    anchor: tuple[float, float],
+    last_result: PoseDetectionResult | None,
+) -> tuple[int, int, int, int]:
+    """
+    バーの位置と直前のランドマークから切り出す領域(x, y, w, h)を決める
+    領域の大きさは固定にして、動画モードの追跡が途切れないようにする
+    """
+    height, width = shape[:2]
+    xs = [anchor[0]]
+    if last_result is not None:
+        xs = [
+            p[0]
+            for p in (last_result.nose, last_result.left_hand, last_result.right_hand)
+            if p is not None
+        ] or xs
+    center_x = sum(xs) / len(xs)
+
+    roi_w = int(width * ROI_WIDTH)
+    roi_h = int(height * ROI_HEIGHT)
+    x = int(np.clip(center_x * width - roi_w / 2, 0, width - roi_w))
+    y = int(np.clip((anchor[1] - ROI_TOP_MARGIN) * height, 0, height - roi_h))
+    return (x, y, roi_w, roi_h)
+
+
+def _track(
+    frame: cv2.Mat, roi: tuple[int, int, int, int]
+) -> PoseDetectionResult | None:
+    """
+    RGBのframeから切り出した領域で追跡し、フレーム全体の割合に直した結果を返す
+    見失った、もしくは領域の端に寄った場合はNoneを返す
+    """
+    global _crop
+    x, y, w, h = roi
+    region = frame[y : y + h, x : x + w]
+    if region.shape[:2] != (h, w):
+        # 領域がフレームからはみ出している
+        return None
+    # 領域の大きさは固定なので、毎回同じバッファに写す
+    if _crop is None or _crop.shape != region.shape:
+        _crop = np.empty(region.shape, dtype=frame.dtype)
+    np.copyto(_crop, region)
+    result = _extract(tracker.process(_crop))
+    points = [result.nose, result.left_hand, result.right_hand]
+    if all(p is None for p in points):
+        return None
+    for p in points:
+        if p is not None and not (
+            ROI_EDGE_MARGIN <= p[0] <= 1 - ROI_EDGE_MARGIN
+            and ROI_EDGE_MARGIN <= p[1] <= 1 - ROI_EDGE_MARGIN
+        ):
+            return None
+
+    height, width = frame.shape[:2]
+
+    def to_frame(p):
+        if p is None:
+            return None
+        return ((x + p[0] * w) / width, (y + p[1] * h) / height)
+
+    return PoseDetectionResult(
+        nose=to_frame(result.nose),
+        left_hand=to_frame(result.left_hand),
+        right_hand=to_frame(result.right_hand),
+    )
+
+
+def _extract(results) -> PoseDetectionResult:
     if results.pose_landmarks:
         nose = results.pose_landmarks.landmark[mp_pose.PoseLandmark.NOSE]
         left_hand = results.pose_landmarks.landmark[mp_pose.PoseLandmark.LEFT_WRIST]
@@ -61,8 +217,12 @@ if __name__ == "__main__":
         logger.error("Could not open video capture")
         exit(1)
 
-    init()
+    mode = sys.argv[2] if len(sys.argv) > 2 else "static"
+    # trackingモードの切り出し基準(バーの位置)
+    anchor = (0.5, 0.3) if mode == "tracking" else None
+    init(mode=mode)
 
+    seq = 0
     while True:
         start_time = time.time()
 
@@ -71,12 +231,13 @@ if __name__ == "__main__":
             logger.error("Failed to read frame from camera")
             break
         frame = cv2.resize(frame, (0, 0), fx=0.3, fy=0.3)
+        seq += 1
 
-        result = detect_pose(frame)
+        result = detect_pose(capture.FrameContext(frame, time.monotonic(), seq), anchor)
         logging.info(f"Detection result: {result}")
 
         elapsed_time = time.time() - start_time
-        logger.info(f"Frame processed in {elapsed_time:.2f} seconds")
+        logger.info(f"Frame processed in {elapsed_time * 1000:.1f} ms ({mode})")
 
         cv2.imshow("Position Detection", frame)
 
@@ -85,4 +246,6 @@ if __name__ == "__main__":
             break
     cap.release()
     pose.close()
+    if tracker is not None:
+        tracker.close()
     cv2.destroyAllWindows()
@@ -2,6 +2,8 @@ import logging
 
 import cv2
 
+import capture
+
 logger = logging.getLogger(__name__)
 
 qr_detector = None
@@ -13,18 +15,24 @@ def init():
     qr_detector = cv2.QRCodeDetector()
 
 
-def detect_qr_code_center(frame: cv2.Mat) -> tuple[float, float] | None:
+def find_qr_code_center(gray: cv2.Mat) -> tuple[float, float] | None:
     """
-    frameに含まれるQRCodeの中心座標を割合で返す
+    グレースケール画像に含まれるQRCodeの中心座標をピクセルで返す
     """
-    _, points = qr_detector.detect(frame)
+    _, points = qr_detector.detect(gray)
     if points is None:
         logger.debug("failed to detect QR code")
         return None
 
-    center = points.mean(axis=0)[0]
-    height, width, _ = frame.shape
-    return (center[0] / width, center[1] / height)
+    center = points.reshape(-1, 2).mean(axis=0)
+    return (float(center[0]), float(center[1]))
+
+
+def detect_qr_code_center(frame: capture.FrameContext) -> tuple[float, float] | None:
+    """
+    フレーム全体からQRCodeを探す
+    """
+    return find_qr_code_center(frame.gray())
 
 
 if __name__ == "__main__":
@@ -32,6 +40,8 @@ if __name__ == "__main__":
     import sys
     import time
 
+    import marker
+
     logging.basicConfig(level=logging.INFO)
 
     cap = cv2.VideoCapture(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -39,7 +49,7 @@ if __name__ == "__main__":
         logger.error("Could not open video capture")
         exit(1)
 
-    init()
+    marker.init("qr")
 
     ret, frame = cap.read()
     if not ret:
@@ -48,7 +58,9 @@ if __name__ == "__main__":
     frame = cv2.resize(frame, (640, 480))
     cv2.imwrite("test_frame.jpg", frame)
     start_time = time.time()
-    center = detect_qr_code_center(frame)
+    center = marker.detect_marker_center(
+        capture.FrameContext(frame, time.monotonic(), 1)
+    )
     elapsed_time = time.time() - start_time
     logger.info(f"QR Code detection took {elapsed_time:.2f} seconds")
 
@@ -0,0 +1,181 @@
+"""
+画面の描画
+
+フェーズの間変わらない部分は背景として1回だけ描き、毎ティックは変わった部分だけを画面に送る
+描いた文字はキャッシュし、同じ文字列を何度もレンダリングしない
+"""
+
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+import pygame as pg
+
+# キャッシュする文字のサーフェスの数
+TEXT_CACHE_SIZE = 128
+
+
+class _Item(NamedTuple):
+    rect: pg.Rect
+    surface: Optional[pg.Surface]
+    color: Optional[tuple[int, int, int]]
+    # サーフェスの中身を書き換えている場合は毎回描き直す
+    changed: bool
+
+
+class CameraPreview:
+    """
+    カメラの画像を毎回同じサーフェスに書き込む
+    以前の表示に合わせて左右を反転する
+    """
+
+    def __init__(self):
+        self.surface: Optional[pg.Surface] = None
+
+    def update(self, image: np.ndarray) -> pg.Surface:
+        """
+        BGRのimageをサーフェスに書き込んで返す
+        """
+        height, width = image.shape[:2]
+        if self.surface is None or self.surface.get_size() != (width, height):
+            # 画面と同じ形式にしておけば、blitのたびに変換されない
+            self.surface = pg.Surface((width, height)).convert()
+        # pixels3dは(x, y, RGB)の順でサーフェスの画素を直接指す
+        pixels = pg.surfarray.pixels3d(self.surface)
+        pixels[...] = image[:, ::-1, ::-1].transpose(1, 0, 2)
+        # 参照が残っている間はサーフェスがロックされる
+        del pixels
+        return self.surface
+
+
+class Renderer:
+    """
+    背景の上に、毎ティック描く要素を重ねる
+
+    描画はpresent()までためておき、前のティックと比べて変わった要素と、
+    それに重なる要素の範囲だけを描き直してpg.display.update()に渡す
+    """
+
+    def __init__(
+        self,
+        screen: pg.Surface,
+        fonts: dict[int, pg.font.Font],
+        background_color: tuple[int, int, int],
+        text_cache_size: int = TEXT_CACHE_SIZE,
+    ):
+        self.screen = screen
+        self.fonts = fonts
+        self.background_color = background_color
+        self.text_cache_size = text_cache_size
+        self._texts: OrderedDict[tuple, pg.Surface] = OrderedDict()
+        self.background = pg.Surface(screen.get_size()).convert()
+        self.background.fill(background_color)
+        self._composing = False
+        self._items: list[_Item] = []
+        self._drawn: list[_Item] = []
+        self._full = True
+
+    def text(
+        self, text: str, size: int, color: tuple[int, int, int]
+    ) -> Optional[pg.Surface]:
+        """
+        文字のサーフェスを返す。最近使われていないものから捨てる
+        """
+        key = (text, size, color)
+        surface = self._texts.get(key)
+        if surface is not None:
+            self._texts.move_to_end(key)
+            return surface
+        font = self.fonts.get(size)
+        if font is None:
+            return None
+        surface = font.render(text, True, color).convert_alpha()
+        self._texts[key] = surface
+        if len(self._texts) > self.text_cache_size:
+            self._texts.popitem(last=False)
+        return surface
+
+    def compose(self, draw: Callable[[], None]) -> None:
+        """
+        drawで描いたものを背景にし、次のpresent()で画面全体を描き直す
+        """
+        self.background.fill(self.background_color)
+        self._composing = True
+        try:
+            draw()
+        finally:
+            self._composing = False
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """
+        次のpresent()で画面全体を描き直す
+        """
+        self._full = True
+
+    def blit(self, surface: pg.Surface, dest, changed: bool = False) -> pg.Rect:
+        """
+        surfaceを描く。同じサーフェスの中身を書き換えた場合はchangedを指定する
+        """
+        rect = surface.get_rect(topleft=tuple(dest)[:2])
+        if self._composing:
+            self.background.blit(surface, rect)
+        else:
+            self._items.append(_Item(rect, surface, None, changed))
+        return rect
+
+    def fill(self, color: tuple[int, int, int], rect) -> pg.Rect:
+        rect = pg.Rect(rect)
+        if self._composing:
+            self.background.fill(color, rect)
+        else:
+            self._items.append(_Item(rect, None, color, False))
+        return rect
+
+    def present(self) -> None:
+        """
+        ためた描画を画面に反映する
+        """
+        items, self._items = self._items, []
+        prev, self._drawn = self._drawn, items
+
+        if self._full:
+            self._full = False
+            self.screen.blit(self.background, (0, 0))
+            for item in items:
+                self._draw(item)
+            pg.display.flip()
+            return
+
+        changed = [
+            item.changed or i >= len(prev) or prev[i] != item
+            for i, item in enumerate(items)
+        ]
+        dirty = [item.rect for item, c in zip(items, changed) if c]
+        dirty += [
+            item.rect for i, item in enumerate(prev) if i >= len(items) or changed[i]
+        ]
+        # 描き直す範囲に重なる要素も、重ね順を保つために描き直す
+        grown = True
+        while grown:
+            grown = False
+            for i, item in enumerate(items):
+                if not changed[i] and item.rect.collidelist(dirty) != -1:
+                    changed[i] = True
+                    dirty.append(item.rect)
+                    grown = True
+
+        bounds = self.screen.get_rect()
+        dirty = [rect.clip(bounds) for rect in dirty]
+        for rect in dirty:
+            self.screen.blit(self.background, rect, rect)
+        for item, c in zip(items, changed):
+            if c:
+                self._draw(item)
+        pg.display.update(dirty)
+
+    def _draw(self, item: _Item) -> None:
+        if item.surface is not None:
+            self.screen.blit(item.surface, item.rect)
+        else:
+            self.screen.fill(item.color, item.rect)
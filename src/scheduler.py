@@ -0,0 +1,205 @@
+"""
+フェーズごとのティックの頻度と、負荷に応じた品質の調整
+
+各フェーズは推論の目標の頻度と、推論1回にかけてよい時間を宣言する
+推論にかかった時間が予算を超え続けたら品質を1段落とし、余裕のある状態が続いたら1段戻す
+落とす順番はカメラの解像度、姿勢推定のモデル、推論の頻度
+品質の段階は推論の種類(stage)ごとに持ち、その推論の時間を縮めるのに効く次元だけを落とす
+"""
+
+import logging
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from inference import InferenceWorker
+
+logger = logging.getLogger(__name__)
+
+# 続けてこの回数予算を超えたら品質を落とす
+OVERLOAD_COUNT = 5
+# 予算に対してこの割合を下回る状態がRESTORE_AFTER_MS続いたら品質を戻す
+HEADROOM_RATIO = 0.5
+RESTORE_AFTER_MS = 10000
+# 戻した直後にまた落とした場合は、次に戻すまでの時間を倍にする(上限あり)
+RESTORE_AFTER_MAX_MS = 300000
+# 品質を変えた直後の結果はモデルの読み込みなどで遅いので数えない
+SETTLE_RESULTS = 3
+# 処理時間の指数移動平均の重み
+SMOOTHING = 0.3
+# 落とすときのカメラの幅(高さは比率を保つ)と、推論の頻度の倍率
+CAPTURE_WIDTHS = (640, 480, 320)
+RATE_SCALES = (1.0, 0.75, 0.5)
+# 落とせる品質の次元(Qualityの属性名)
+DIMENSIONS = ("capture_size", "pose_model_complexity", "rate_scale")
+
+
+@dataclass(frozen=True)
+class Quality:
+    capture_size: tuple[int, int]
+    pose_model_complexity: int
+    rate_scale: float = 1.0
+
+
+def quality_levels(
+    capture_size: tuple[int, int],
+    pose_model_complexity: int,
+    dimensions: tuple[str, ...] = DIMENSIONS,
+) -> list[Quality]:
+    """
+    指定された設定を最高として、dimensionsの次元だけを落とす順に並べた品質の段階
+    """
+    levels = [Quality(capture_size, pose_model_complexity)]
+    if "capture_size" in dimensions:
+        width, height = capture_size
+        levels += [
+            Quality((w, round(height * w / width)), pose_model_complexity)
+            for w in CAPTURE_WIDTHS
+            if w < width
+        ]
+    if "pose_model_complexity" in dimensions:
+        levels += [
+            replace(levels[-1], pose_model_complexity=complexity)
+            for complexity in range(pose_model_complexity - 1, -1, -1)
+        ]
+    if "rate_scale" in dimensions:
+        levels += [replace(levels[-1], rate_scale=scale) for scale in RATE_SCALES[1:]]
+    return levels
+
+
+class Scheduler:
+    """
+    現在のフェーズの目標からティックの頻度を決め、推論の処理時間を見て品質を上げ下げする
+    段階はstageごとに覚えておき、同じstageのフェーズに戻ったらそこから再開する
+    """
+
+    def __init__(
+        self,
+        levels: dict[str, list[Quality]],
+        apply: Callable[[Quality, Quality], None],
+        load_shedding: bool = True,
+    ):
+        """
+        levelsはstageごとの品質の段階で、どれも先頭は同じ設定にする
+        applyは品質を変えるときに(変更前, 変更後)で呼ばれる
+        """
+        self.levels = levels
+        self.stage: str | None = None
+        self.load_shedding = load_shedding
+        self.rate = 5.0
+        self.latency_budget_ms: float | None = None
+        self._apply = apply
+        self._stage_levels = dict.fromkeys(levels, 0)
+        self._quality = next(iter(levels.values()))[0]
+        self._restore_after_ms = RESTORE_AFTER_MS
+        self._last_change = 0
+        self._since_change_ms = 0
+        self._settle = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self._latency_ms: float | None = None
+        self._over = 0
+        self._headroom_ms = 0
+        self._seen: tuple["InferenceWorker", int] | None = None
+
+    @property
+    def level(self) -> int:
+        return self._stage_levels.get(self.stage, 0)
+
+    @property
+    def quality(self) -> Quality:
+        return self._quality
+
+    @property
+    def tick_rate(self) -> float:
+        return self.rate * self.quality.rate_scale
+
+    @property
+    def budget_ms(self) -> float | None:
+        """
+        推論の頻度を落とした分だけ、1回にかけてよい時間は延びる
+        """
+        if self.latency_budget_ms is None:
+            return None
+        return self.latency_budget_ms / self.quality.rate_scale
+
+    def set_phase(
+        self, rate: float, latency_budget_ms: float | None, stage: str | None = None
+    ) -> None:
+        """
+        stageが無いフェーズでは、カメラやモデルを切り替え直さないように今の設定のまま頻度だけ戻す
+        """
+        self.rate = rate
+        self.latency_budget_ms = latency_budget_ms if stage is not None else None
+        self.stage = stage
+        if stage is None:
+            self._set_quality(replace(self._quality, rate_scale=1.0))
+        else:
+            self._set_quality(self.levels[stage][self.level])
+        self._reset()
+
+    def update(self, worker: "InferenceWorker | None", dt: int) -> None:
+        """
+        毎ティック呼び、workerの推論が新しく完了していればその処理時間を評価する
+        """
+        self._since_change_ms += dt
+        budget = self.budget_ms
+        if not self.load_shedding or worker is None or budget is None:
+            return
+        if self._seen is None or self._seen[0] is not worker:
+            self._seen = (worker, worker.completed)
+        if worker.completed != self._seen[1]:
+            self._seen = (worker, worker.completed)
+            self._observe(worker.last_latency_ms, budget)
+
+        if (
+            self._over >= OVERLOAD_COUNT
+            and self.level < len(self.levels[self.stage]) - 1
+        ):
+            if self._last_change < 0 and self._since_change_ms < self._restore_after_ms:
+                # 戻したばかりの品質がまた重かった
+                self._restore_after_ms = min(
+                    self._restore_after_ms * 2, RESTORE_AFTER_MAX_MS
+                )
+            self._change(1)
+        elif (
+            self._latency_ms is not None and self._latency_ms < budget * HEADROOM_RATIO
+        ):
+            self._headroom_ms += dt
+            if self._headroom_ms >= self._restore_after_ms and self.level > 0:
+                self._change(-1)
+        else:
+            self._headroom_ms = 0
+
+    def _observe(self, latency_ms: float, budget_ms: float) -> None:
+        if self._settle > 0:
+            self._settle -= 1
+            return
+        if self._latency_ms is None:
+            self._latency_ms = latency_ms
+        else:
+            self._latency_ms += SMOOTHING * (latency_ms - self._latency_ms)
+        self._over = self._over + 1 if latency_ms > budget_ms else 0
+
+    def _change(self, step: int) -> None:
+        budget_ms = self.budget_ms
+        self._stage_levels[self.stage] += step
+        self._last_change = step
+        self._since_change_ms = 0
+        quality = self.levels[self.stage][self.level]
+        logger.info(
+            f"{'Lowering' if step > 0 else 'Restoring'} {self.stage} quality to level"
+            f" {self.level}: {quality}"
+            f" (latency {self._latency_ms:.0f}ms, budget {budget_ms:.0f}ms)"
+        )
+        self._set_quality(quality)
+        self._reset()
+
+    def _set_quality(self, quality: Quality) -> None:
+        if quality == self._quality:
+            return
+        previous = self._quality
+        self._quality = quality
+        self._apply(previous, quality)
+        self._settle = SETTLE_RESULTS
@@ -0,0 +1,8 @@
+import importlib.util
+import sys
+import types
+
+# face_recognition(dlib)が無い環境でもfaceを読み込めるようにする
+# 検出や特徴量の計算を使うテストは、呼び出しをmonkeypatchで差し替える
+if importlib.util.find_spec("face_recognition") is None:
+    sys.modules["face_recognition"] = types.ModuleType("face_recognition")
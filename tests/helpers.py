@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class Result:
+    """
+    pose.PoseDetectionResultと同じ形。poseはmediapipeを読み込むので使わない
+    """
+
+    nose: tuple[float, float] | None
+    left_hand: tuple[float, float] | None
+    right_hand: tuple[float, float] | None
@@ -0,0 +1,83 @@
+import pickle
+import time
+
+import pytest
+
+import capture
+
+
+class FakeCapture:
+    """
+    撮るたびに画素値が1ずつ増える画像を返すカメラ
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        time.sleep(0.001)
+        return True
+
+    def retrieve(self, image):
+        self.value = (self.value + 1) % 256
+        image[...] = self.value
+        return True, image
+
+
+@pytest.fixture
+def allocated(monkeypatch):
+    monkeypatch.setattr(capture, "cap", FakeCapture())
+    monkeypatch.setattr(capture, "_threaded", True)
+    monkeypatch.setattr(capture, "_expected_shape", (4, 6))
+    monkeypatch.setattr(capture, "_pool", {})
+    monkeypatch.setattr(capture, "_seq", 0)
+    # プールが空で新しく確保したバッファの数を数える
+    allocated = []
+    take_buffer = capture._take_buffer
+
+    def counting_take_buffer(shape):
+        with capture._pool_lock:
+            if not capture._pool.get(shape):
+                allocated.append(shape)
+        return take_buffer(shape)
+
+    monkeypatch.setattr(capture, "_take_buffer", counting_take_buffer)
+    capture._start_grabber()
+    yield allocated
+    capture._stop_grabber()
+
+
+def wait_for(seq):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        frame = capture.read_frame()
+        if frame is not None and frame.seq >= seq:
+            return frame
+        time.sleep(0.001)
+    raise TimeoutError
+
+
+def test_held_frame_is_not_overwritten(allocated):
+    held = wait_for(1)
+    value = held.image[0, 0, 0]
+    # 手元に残したフレームのバッファには、その後の撮影で書き込まれない
+    latest = wait_for(held.seq + 20)
+    assert (held.image == value).all()
+    assert latest.image[0, 0, 0] != value
+
+
+def test_released_frames_reuse_buffers(allocated):
+    # 参照されなくなったバッファは使い回されるので、撮影のたびには確保しない
+    wait_for(100)
+    assert len(allocated) <= 4
+
+
+def test_pickled_frame_keeps_image(allocated):
+    frame = wait_for(1)
+    copied = pickle.loads(pickle.dumps(frame))
+    del frame
+    wait_for(copied.seq + 20)
+    assert (copied.image == copied.image[0, 0, 0]).all()
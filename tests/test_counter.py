@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import counter
+from helpers import Result
+
+BAR = (0.5, 0.3)
+
+
+def random_session(rng: np.random.Generator, n: int = 300):
+    timestamps = np.cumsum(rng.uniform(20, 120, n))
+    nose_y = 0.4 + 0.2 * np.sin(timestamps / 400) + rng.normal(0, 0.03, n)
+    # 半分ほどのセッションは途中で手を離して終わる
+    released_at = rng.integers(n // 2, n) if rng.random() < 0.5 else n
+    results = []
+    for i in range(n):
+        if rng.random() < 0.05:
+            results.append(None)
+            continue
+        hand_y = BAR[1] if i < released_at and rng.random() > 0.03 else 0.9
+        results.append(
+            Result((0.5, float(nose_y[i])), (0.6, hand_y), (0.4, BAR[1] - 0.01))
+        )
+    return results, timestamps
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_count_reps_matches_streaming_counter(seed):
+    results, timestamps = random_session(np.random.default_rng(seed))
+    rep_counter = counter.RepCounter(BAR)
+    events = list(rep_counter.feed(zip(results, timestamps)))
+
+    counted = counter.count_reps(counter.to_array(results), timestamps, BAR)
+
+    np.testing.assert_array_equal(counted, [e.timestamp_ms for e in events])
+
+
+def test_counts_once_per_rep():
+    rep_counter = counter.RepCounter(BAR)
+    hands = ((0.6, BAR[1]), (0.4, BAR[1]))
+    ys = [0.6, 0.25, 0.28, 0.6, 0.25, 0.45, 0.25]
+    for i, y in enumerate(ys):
+        rep_counter.update(Result((0.5, y), *hands), i * 100)
+    # 0.45はバーから十分下がっていないので3回目は数えない
+    assert rep_counter.count == 2
+
+
+def test_expire_finishes_without_results():
+    rep_counter = counter.RepCounter(BAR, timeout_ms=1000)
+    rep_counter.update(Result((0.5, 0.6), (0.6, BAR[1]), (0.4, BAR[1])), 0)
+    assert not rep_counter.expire(999)
+    assert rep_counter.expire(1000)
+
+
+def test_create_rejects_unknown_detector():
+    with pytest.raises(ValueError):
+        counter.create("unknown", BAR)
@@ -0,0 +1,79 @@
+import sqlite3
+
+import psycopg
+import pytest
+
+import db
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    # 書き込みスレッドは起動せず、flush_outboxを直接呼ぶ
+    monkeypatch.setattr(db, "_outbox_writer", object())
+    monkeypatch.setattr(db, "_outbox_path", None)
+    db.init_outbox(str(tmp_path / "outbox.sqlite3"))
+    sent = []
+
+    def register_records(records):
+        if any(name == "bad" for name, _, _ in records):
+            raise psycopg.IntegrityError("null value in column member_id")
+        sent.extend(records)
+
+    monkeypatch.setattr(db, "register_records", register_records)
+    return sent
+
+
+def rows(table):
+    with sqlite3.connect(db._outbox_path) as conn:
+        return conn.execute(f"SELECT name, count FROM {table} ORDER BY id").fetchall()
+
+
+def test_flush(outbox):
+    db.enqueue_record("a", 10, False)
+    db.enqueue_record("b", 20, True)
+    assert db.flush_outbox() == 2
+    assert outbox == [("a", 10, False), ("b", 20, True)]
+    assert rows("outbox") == []
+    assert db.flush_outbox() == 0
+
+
+def test_rejected_rows_move_to_failed(outbox):
+    db.enqueue_record("a", 10, False)
+    db.enqueue_record("bad", 20, False)
+    db.enqueue_record("c", 30, True)
+    assert db.flush_outbox() == 3
+    assert outbox == [("a", 10, False), ("c", 30, True)]
+    assert rows("outbox") == []
+    assert rows("outbox_failed") == [("bad", 20)]
+
+
+def test_connection_errors_keep_rows(outbox, monkeypatch):
+    def unavailable(records):
+        raise psycopg.OperationalError("Database unavailable")
+
+    monkeypatch.setattr(db, "register_records", unavailable)
+    db.enqueue_record("a", 10, False)
+    with pytest.raises(psycopg.OperationalError):
+        db.flush_outbox()
+    assert rows("outbox") == [("a", 10)]
+    assert rows("outbox_failed") == []
+
+
+def test_connection_lost_while_isolating(outbox, monkeypatch):
+    # 1件ずつ送っている途中で接続が切れても、送れた分は消え、残りは再送される
+    calls = []
+
+    def register_records(records):
+        calls.append(records)
+        if len(calls) == 1:
+            raise psycopg.DataError("value out of range")
+        if len(calls) == 3:
+            raise psycopg.OperationalError("connection lost")
+
+    monkeypatch.setattr(db, "register_records", register_records)
+    for name in "abc":
+        db.enqueue_record(name, 1, False)
+    with pytest.raises(psycopg.OperationalError):
+        db.flush_outbox()
+    assert rows("outbox") == [("b", 1), ("c", 1)]
+    assert rows("outbox_failed") == []
@@ -0,0 +1,174 @@
+import numpy as np
+import pytest
+
+import capture
+import face
+
+
+def make_entries(rng, n_people=20, per_person=3):
+    return [
+        {"name": f"p{i}", "encodings": rng.normal(size=(per_person, 128)).tolist()}
+        for i in range(n_people)
+    ]
+
+
+def brute_force(entries, queries):
+    return np.array(
+        [
+            [
+                np.linalg.norm(np.asarray(e["encodings"]) - q, axis=1).min()
+                for e in entries
+            ]
+            for q in queries
+        ]
+    )
+
+
+def test_distances_are_per_person_minimum():
+    rng = np.random.default_rng(0)
+    entries = make_entries(rng)
+    # 人の順に並んでいなくても、from_entriesで並べ替える
+    split = [
+        {"name": e["name"], "encoding": row} for e in entries for row in e["encodings"]
+    ]
+    rng.shuffle(split)
+    gallery = face.Gallery.from_entries(split)
+    queries = rng.normal(size=(4, 128))
+
+    expected = brute_force(entries, queries)
+    order = [gallery.names.index(e["name"]) for e in entries]
+    np.testing.assert_allclose(
+        gallery.distances(queries)[:, order], expected, rtol=1e-4
+    )
+
+
+def test_match_threshold():
+    rng = np.random.default_rng(1)
+    entries = make_entries(rng, n_people=3)
+    gallery = face.Gallery.from_entries(entries)
+    query = np.asarray(entries[1]["encodings"][0]) + 0.001
+    far = np.full(128, 100.0)
+    assert gallery.match(np.stack([query, far]), 0.6) == ["p1", None]
+
+
+def test_with_changes_replaces_and_removes():
+    rng = np.random.default_rng(2)
+    entries = make_entries(rng, n_people=4)
+    gallery = face.Gallery.from_entries(entries)
+    replacement = rng.normal(size=(2, 128)).astype(np.float32)
+
+    changed = gallery.with_changes({"p1": replacement}, {"p2"})
+
+    assert sorted(changed.names) == ["p0", "p1", "p3"]
+    np.testing.assert_array_equal(changed.member_encodings("p1"), replacement)
+    np.testing.assert_array_equal(
+        changed.member_encodings("p3"), gallery.member_encodings("p3")
+    )
+    assert changed.match(replacement[:1], 0.01) == ["p1"]
+    # 元のギャラリーは変わらない
+    assert "p2" in gallery.names
+
+
+def test_ivf_matches_flat_for_nearby_queries():
+    rng = np.random.default_rng(3)
+    entries = make_entries(rng, n_people=50)
+    flat = face.Gallery.from_entries(entries)
+    ivf = face.Gallery.from_entries(entries)
+    ivf.build_index()
+    queries = np.stack([np.asarray(e["encodings"][0]) + 0.01 for e in entries[:10]])
+    assert ivf.match(queries, 0.6) == flat.match(queries, 0.6)
+
+
+def test_rejects_empty_encodings():
+    with pytest.raises(ValueError):
+        face.Gallery.from_entries([{"name": "a", "encodings": []}])
+    gallery = face.Gallery.from_entries(make_entries(np.random.default_rng(4), 2))
+    with pytest.raises(ValueError):
+        gallery.with_changes({"b": np.empty((0, 128))}, set())
+
+
+@pytest.fixture
+def still_scene(monkeypatch):
+    """
+    同じ位置に1人の顔が写り続ける場面。検出と特徴量の計算は差し替える
+    """
+    encoding = np.full(128, 0.05)
+    calls = {"locations": 0, "encodings": 0}
+
+    def face_locations(image):
+        calls["locations"] += 1
+        return [(40, 160, 160, 40)]
+
+    def face_encodings(image, locations):
+        calls["encodings"] += 1
+        return [encoding + 0.01]
+
+    monkeypatch.setattr(
+        face.face_recognition, "face_locations", face_locations, raising=False
+    )
+    monkeypatch.setattr(
+        face.face_recognition, "face_encodings", face_encodings, raising=False
+    )
+    others = np.random.default_rng(7).normal(size=(2, 128))
+    monkeypatch.setattr(
+        face,
+        "gallery",
+        face.Gallery.from_entries(
+            [
+                {"name": "alice", "encoding": encoding.tolist()},
+                *(
+                    {"name": f"p{i}", "encoding": e.tolist()}
+                    for i, e in enumerate(others)
+                ),
+            ]
+        ),
+    )
+    face.reset_tracking()
+    image = np.full((480, 640, 3), 128, dtype=np.uint8)
+    return image, calls
+
+
+def recognize_session(image, ticks=10):
+    voter = face.IdentityVoter()
+    for seq in range(ticks):
+        frame = capture.FrameContext(image, seq / 10, seq)
+        name = voter.add(face.recognize_faces(frame))
+        if name is not None:
+            return name, seq
+    return None, ticks
+
+
+def test_still_face_is_encoded_until_voter_decides(still_scene):
+    image, calls = still_scene
+    # 1回目で位置を覚え、2回目と3回目で特徴量を計算して確定する
+    assert recognize_session(image) == ("alice", 2)
+    assert calls["encodings"] == face.MIN_VOTE_FRAMES
+
+    # 特徴量が揃えば、静止したフレームでは検出もしない
+    locations = calls["locations"]
+    face.recognize_faces(capture.FrameContext(image, 1.0, 10))
+    assert calls["locations"] == locations
+
+
+def test_next_session_recognizes_after_reset(still_scene):
+    image, _ = still_scene
+    assert recognize_session(image)[0] == "alice"
+    face.reset_tracking()
+    assert recognize_session(image)[0] == "alice"
+
+
+def test_still_scene_without_faces_keeps_detecting(still_scene, monkeypatch):
+    image, calls = still_scene
+    monkeypatch.setattr(face.face_recognition, "face_locations", lambda image: [])
+    for seq in range(3):
+        face.recognize_faces(capture.FrameContext(image, seq / 10, seq))
+
+    # 誰もいなかった場面に人が入ってきたら見つける
+    seen = []
+    monkeypatch.setattr(
+        face.face_recognition,
+        "face_locations",
+        lambda image: seen.append(1) or [(40, 160, 160, 40)],
+    )
+    face.recognize_faces(capture.FrameContext(image, 0.3, 3))
+    assert seen
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import face_store
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    encodings = rng.normal(size=(5, 128)).astype(np.float32)
+    labels = np.array([0, 0, 1, 2, 2], dtype=np.int32)
+    sq_norms = np.einsum("ij,ij->i", encodings, encodings)
+    path = str(tmp_path / "faces.bin")
+    face_store.save(path, encodings, labels, ["a", "b", "c"], sq_norms)
+
+    loaded_encodings, loaded_labels, names, loaded_sq_norms = face_store.load(path)
+    np.testing.assert_array_equal(loaded_encodings, encodings)
+    np.testing.assert_array_equal(loaded_labels, labels)
+    np.testing.assert_array_equal(loaded_sq_norms, sq_norms)
+    assert names == ["a", "b", "c"]
+
+
+def test_empty(tmp_path):
+    path = str(tmp_path / "faces.bin")
+    empty = np.empty((0, 128), dtype=np.float32)
+    face_store.save(path, empty, np.empty(0, np.int32), [], np.empty(0, np.float32))
+    encodings, labels, names, _ = face_store.load(path)
+    assert encodings.shape == (0, 128)
+    assert len(labels) == 0
+    assert names == []
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "faces.bin"
+    path.write_bytes(b"\0" * face_store.HEADER_SIZE)
+    with pytest.raises(ValueError):
+        face_store.load(str(path))
@@ -0,0 +1,38 @@
+import numpy as np
+
+import filters
+from helpers import Result
+
+
+def test_constant_input_is_unchanged():
+    f = filters.OneEuroFilter()
+    for i in range(10):
+        value = f((0.3, 0.7), i * 33)
+    np.testing.assert_allclose(value, (0.3, 0.7))
+
+
+def test_reduces_noise_and_follows_steps():
+    rng = np.random.default_rng(0)
+    f = filters.OneEuroFilter()
+    noisy = 0.5 + rng.normal(0, 0.01, 60)
+    smoothed = [f(y, i * 33)[()] for i, y in enumerate(noisy)]
+    assert np.std(smoothed[10:]) < np.std(noisy[10:])
+
+    for i in range(60, 90):
+        value = f(0.2, i * 33)
+    assert abs(value - 0.2) < 0.01
+
+
+def test_ignores_non_increasing_timestamps():
+    f = filters.OneEuroFilter()
+    f(0.5, 100)
+    assert f(0.9, 100) == 0.5
+
+
+def test_smoother_restarts_after_gap():
+    smoother = filters.LandmarkSmoother()
+    smoother(Result((0.5, 0.5), None, (0.4, 0.3)), 0)
+    result = smoother(Result((0.5, 0.1), None, None), filters.MAX_GAP_MS + 1)
+    assert result.nose == (0.5, 0.1)
+    assert result.left_hand is None
+    assert result.right_hand is None
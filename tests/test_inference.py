@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+
+import capture
+import inference
+
+
+def make_frame(seq: int) -> capture.FrameContext:
+    return capture.FrameContext(np.zeros((4, 4, 3), dtype=np.uint8), seq / 10, seq)
+
+
+def wait_done(worker: inference.InferenceWorker) -> None:
+    worker._future.result(timeout=5)
+
+
+def test_unpolled_result_is_not_replaced():
+    worker = inference.InferenceWorker(lambda frame: frame.seq * 10)
+    try:
+        assert worker.submit(make_frame(1))
+        wait_done(worker)
+        # 完了していても受け取るまでは次のフレームを投げない
+        assert not worker.submit(make_frame(2))
+        result = worker.poll()
+        assert (result.seq, result.value) == (1, 10)
+        assert worker.completed == 1
+
+        assert worker.submit(make_frame(2))
+        wait_done(worker)
+        assert worker.poll().value == 20
+    finally:
+        worker.shutdown()
+
+
+def test_submit_then_poll_every_tick_returns_results():
+    # フェーズは毎ティック、新しいフレームを投げてすぐにpoll()する
+    worker = inference.InferenceWorker(lambda frame: frame.seq)
+    try:
+        results = []
+        for seq in range(1, 11):
+            worker.submit(make_frame(seq))
+            result = worker.poll()
+            if result is not None:
+                results.append(result.value)
+            time.sleep(0.01)
+        assert len(results) >= 4
+    finally:
+        worker.shutdown()
+
+
+def test_skips_frames_already_submitted():
+    worker = inference.InferenceWorker(lambda frame: frame.seq)
+    try:
+        assert worker.submit(make_frame(3))
+        wait_done(worker)
+        worker.poll()
+        assert not worker.submit(make_frame(3))
+        assert not worker.submit(make_frame(2))
+    finally:
+        worker.shutdown()
+
+
+def test_discards_stale_results():
+    worker = inference.InferenceWorker(lambda frame: frame.seq)
+    try:
+        worker.submit(make_frame(1))
+        worker.discard_before(1)
+        wait_done(worker)
+        assert worker.poll() is None
+        assert worker.completed == 1
+    finally:
+        worker.shutdown()
@@ -0,0 +1,76 @@
+import json
+
+import numpy as np
+import pytest
+
+import capture
+import marker
+
+
+@pytest.fixture
+def fake_marker(monkeypatch):
+    """
+    マーカーが(0.5, 0.25)にあるフレーム。周辺を探したか全体を探したかを記録する
+    """
+    calls = []
+
+    def finder(gray):
+        calls.append("near")
+        return (gray.shape[1] / 2, gray.shape[0] / 2)
+
+    def detector(frame):
+        calls.append("full")
+        return (320.0, 120.0)
+
+    monkeypatch.setattr(marker, "_finder", finder)
+    monkeypatch.setattr(marker, "_detector", detector)
+    return calls
+
+
+def make_frame(seq=1):
+    return capture.FrameContext(np.zeros((480, 640, 3), dtype=np.uint8), 0.0, seq)
+
+
+def test_searches_near_given_center_only(fake_marker):
+    assert marker.detect_marker_center(make_frame()) == (0.5, 0.25)
+    # 前回の位置は呼び出し側が渡したときだけ使う
+    assert marker.detect_marker_center(make_frame()) == (0.5, 0.25)
+    assert fake_marker == ["full", "full"]
+    assert marker.detect_marker_center(make_frame(), (0.5, 0.25)) == (0.5, 0.25)
+    assert fake_marker[-1] == "near"
+
+
+def test_calibrators_keep_their_own_center(fake_marker):
+    first = marker.Calibrator(frames=2)
+    assert first.update(make_frame(1)) is None
+    assert first.update(make_frame(2)) == (0.5, 0.25)
+    assert fake_marker == ["full", "near"]
+
+    # 別のCalibratorは前の検出位置を引き継がない
+    marker.Calibrator(frames=2).update(make_frame(3))
+    assert fake_marker[-1] == "full"
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "not json",
+        "[1, 2]",
+        json.dumps({"center": [0.5, 0.3]}),
+        json.dumps({"resolution": [640, 480]}),
+        json.dumps({"center": [0.5], "resolution": [640, 480]}),
+        json.dumps({"center": [0.5, 0.3], "resolution": [320, 240]}),
+        json.dumps({"center": [0.5, 0.3], "resolution": [640, 480], "marker": "qr"}),
+    ],
+)
+def test_load_calibration_ignores_unusable_files(tmp_path, content):
+    path = tmp_path / "calibration.json"
+    path.write_text(content)
+    assert marker.load_calibration(str(path), (640, 480)) is None
+
+
+def test_calibration_round_trip(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    marker.save_calibration(path, (0.5, 0.3), (640, 480))
+    assert marker.load_calibration(path, (640, 480)) == (0.5, 0.3)
+    assert marker.load_calibration(str(tmp_path / "missing.json"), (640, 480)) is None
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", True)
+    monkeypatch.setattr(metrics, "_samples", {})
+    monkeypatch.setattr(metrics, "_counts", {})
+    monkeypatch.setattr(metrics, "_sums", {})
+
+
+def test_disabled_records_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", False)
+    monkeypatch.setattr(metrics, "_samples", {})
+    with metrics.span("stage"):
+        pass
+    assert metrics.snapshot() == {}
+
+
+def test_snapshot_quantiles(enabled):
+    for value in range(1, 101):
+        metrics.record("stage", float(value))
+    stage = metrics.snapshot()["stage"]
+    assert stage["count"] == 100
+    assert stage["sum_ms"] == 5050
+    assert stage["p50_ms"] == pytest.approx(50.5)
+    assert stage["p99_ms"] == pytest.approx(99.01)
+
+
+def test_window_keeps_recent_samples(enabled):
+    for _ in range(metrics.WINDOW):
+        metrics.record("stage", 1.0)
+    for _ in range(metrics.WINDOW):
+        metrics.record("stage", 2.0)
+    stage = metrics.snapshot()["stage"]
+    assert stage["count"] == 2 * metrics.WINDOW
+    assert stage["p50_ms"] == 2.0
+
+
+def test_timed_and_span_record(enabled):
+    @metrics.timed("fn")
+    def fn():
+        return 42
+
+    assert fn() == 42
+    with metrics.span("block"):
+        pass
+    assert set(metrics.snapshot()) == {"block", "fn"}
+
+
+def test_dump_formats(enabled, tmp_path):
+    metrics.record("pose", 10.0)
+    path = tmp_path / "metrics.json"
+    metrics.dump(str(path))
+    assert json.loads(path.read_text())["stages"]["pose"]["count"] == 1
+
+    text = metrics.to_prometheus()
+    assert f'{metrics.PROMETHEUS_METRIC}{{stage="pose",quantile="0.5"}} 10.0' in text
+    assert f'{metrics.PROMETHEUS_METRIC}_count{{stage="pose"}} 1' in text
+
+
+def test_unbounded_window(monkeypatch):
+    monkeypatch.setattr(metrics, "_samples", {})
+    monkeypatch.setattr(metrics, "_counts", {})
+    monkeypatch.setattr(metrics, "_sums", {})
+    monkeypatch.setattr(metrics, "_window", metrics.WINDOW)
+    monkeypatch.setattr(metrics, "_enabled", False)
+    metrics.enable(window=None)
+    for value in range(2 * metrics.WINDOW):
+        metrics.record("stage", float(value))
+    # 最初の計測も分位点に含まれる
+    assert metrics.snapshot()["stage"]["p50_ms"] == pytest.approx(metrics.WINDOW - 0.5)
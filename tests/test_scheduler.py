@@ -0,0 +1,111 @@
+import scheduler
+from scheduler import Quality
+
+
+class Worker:
+    completed = 0
+    last_latency_ms = 0.0
+
+    def finish(self, latency_ms: float) -> None:
+        self.completed += 1
+        self.last_latency_ms = latency_ms
+
+
+def make_scheduler():
+    applied = []
+    levels = {
+        "face": scheduler.quality_levels((640, 480), 1, ("rate_scale",)),
+        "pose": scheduler.quality_levels((640, 480), 1),
+    }
+    sched = scheduler.Scheduler(levels, lambda _, q: applied.append(q))
+    return sched, applied
+
+
+def run(sched, worker, latency_ms, ticks, dt=100):
+    for _ in range(ticks):
+        worker.finish(latency_ms)
+        sched.update(worker, dt)
+
+
+def test_quality_levels_order():
+    levels = scheduler.quality_levels((640, 480), 1)
+    assert levels == [
+        Quality((640, 480), 1),
+        Quality((480, 360), 1),
+        Quality((320, 240), 1),
+        Quality((320, 240), 0),
+        Quality((320, 240), 0, 0.75),
+        Quality((320, 240), 0, 0.5),
+    ]
+    assert scheduler.quality_levels((640, 480), 1, ("rate_scale",)) == [
+        Quality((640, 480), 1),
+        Quality((640, 480), 1, 0.75),
+        Quality((640, 480), 1, 0.5),
+    ]
+
+
+def test_lowers_quality_when_over_budget():
+    sched, applied = make_scheduler()
+    worker = Worker()
+    sched.set_phase(10, 100, "pose")
+    run(sched, worker, 50, 20)
+    assert sched.level == 0
+
+    run(sched, worker, 500, scheduler.SETTLE_RESULTS + scheduler.OVERLOAD_COUNT)
+    assert sched.level == 1
+    assert applied == [Quality((480, 360), 1)]
+
+
+def test_restores_quality_with_headroom():
+    sched, _ = make_scheduler()
+    worker = Worker()
+    sched.set_phase(10, 100, "pose")
+    run(sched, worker, 500, scheduler.OVERLOAD_COUNT + 1)
+    assert sched.level == 1
+
+    run(
+        sched,
+        worker,
+        10,
+        scheduler.RESTORE_AFTER_MS // 100 + scheduler.SETTLE_RESULTS + 2,
+    )
+    assert sched.level == 0
+
+
+def test_face_stage_keeps_resolution():
+    sched, applied = make_scheduler()
+    worker = Worker()
+    sched.set_phase(10, 100, "pose")
+    run(sched, worker, 500, scheduler.OVERLOAD_COUNT + 1)
+    assert sched.quality.capture_size == (480, 360)
+
+    sched.set_phase(5, 400, "face")
+    assert sched.quality == Quality((640, 480), 1)
+    run(sched, worker, 2000, scheduler.SETTLE_RESULTS + scheduler.OVERLOAD_COUNT + 1)
+    assert sched.quality == Quality((640, 480), 1, 0.75)
+    assert sched.tick_rate == 5 * 0.75
+
+    # 姿勢推定に戻ると、落としてあった段階から再開する
+    sched.set_phase(10, 100, "pose")
+    assert sched.quality == Quality((480, 360), 1)
+    assert applied[-1] == Quality((480, 360), 1)
+
+
+def test_phase_without_stage_resets_rate_only():
+    sched, _ = make_scheduler()
+    worker = Worker()
+    sched.set_phase(5, 400, "face")
+    run(sched, worker, 2000, scheduler.OVERLOAD_COUNT + 1)
+    sched.set_phase(30, None)
+    assert sched.quality == Quality((640, 480), 1)
+    assert sched.tick_rate == 30
+    assert sched.budget_ms is None
+
+
+def test_disabled_load_shedding_keeps_quality():
+    sched, applied = make_scheduler()
+    sched.load_shedding = False
+    sched.set_phase(10, 100, "pose")
+    run(sched, Worker(), 500, 50)
+    assert sched.level == 0
+    assert applied == []